@@ -12,15 +12,37 @@
 # -------------------------------------------------------------------------------
 
 import json
+import os
 import sys
 import getopt
+import hashlib
 import pickle
+import tempfile
+import threading
 import httplib, urllib
 import xml.etree.ElementTree
 import unicodedata
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from datetime import date, datetime, timedelta
 from textwrap import wrap
 from math import radians, cos, sin, asin, sqrt
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on this platform, cache locks always succeed
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 needs the pytracemalloc package, which also needs a Python
+    # built with its patch. Without it memory reports only have deep sizes
+    tracemalloc = None
 
 # -------------------------------------------------------------------------------
 #   debug
@@ -35,33 +57,147 @@ def debug(s):
 # -------------------------------------------------------------------------------
 # Cache
 #
-# Implements object pickling and unpickling via cache file
+# Implements object pickling and unpickling via cache file.
+# Files are written to a temporary file then renamed into place, so readers
+# never see a partly written file, and carry a checksum verified on read.
 # -------------------------------------------------------------------------------
 class Cache:
 
+    # First line of cache files, followed by payload checksum
+    _header = "caltrain cache sha1 "
+
+    # Mode of new cache files, readable by all. Not derived from the umask,
+    # since reading that means setting it for all threads of the process
+    DEFAULT_MODE = 0644
+
     # --------------------------------
     @staticmethod
     def get_file_objects(file_path):
-        """ Opens cache file and returns list of objects """
+        """ Opens cache file and returns list of objects. Returns an empty
+        list if file is missing, corrupt or fails its checksum """
         obj_list = []
         try:
-            with open(file_path) as f:
-                obj_list = pickle.load(f)
-        except Exception:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            if data.startswith(Cache._header):
+                header, payload = data.split('\n', 1)
+                if hashlib.sha1(payload).hexdigest() != header[len(Cache._header):]:
+                    raise ValueError("checksum mismatch")
+                obj_list = pickle.loads(payload)
+            else:
+                # File from before checksums were added
+                obj_list = pickle.loads(data)
+        except Exception as e:
             # Ignore, but should be logged in reality
-            pass
+            debug("Can't read cache file %s: %s" % (file_path, e))
         return obj_list
 
     # --------------------------------
     @staticmethod
     def put_file_objects(file_path, obj_list):
-        """ Opens cache file and writes list of objects """
+        """ Writes list of objects to cache file, atomically replacing it """
         try:
-            with open(file_path, 'w') as f:
-                pickle.dump(obj_list, f)
-        except Exception:
+            payload = pickle.dumps(obj_list)
+            directory = os.path.dirname(os.path.abspath(file_path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix=os.path.basename(file_path) + '.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write("%s%s\n" % (Cache._header,
+                                        hashlib.sha1(payload).hexdigest()))
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # Temporary files are owner only. Keep the replaced file's
+                # mode, so caches stay shared between users
+                try:
+                    mode = os.stat(file_path).st_mode & 0777
+                except OSError:
+                    mode = Cache.DEFAULT_MODE
+                os.chmod(tmp_path, mode)
+                if os.name == 'nt' and os.path.exists(file_path):
+                    # Windows can't rename over a file
+                    os.remove(file_path)
+                os.rename(tmp_path, file_path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except Exception as e:
             # Ignore, but should be logged in reality
-            pass
+            debug("Can't write cache file %s: %s" % (file_path, e))
+
+# -------------------------------------------------------------------------------
+# CacheLock
+#
+# Advisory lock on a cache file, held through a companion .lock file, so that
+# only one process (or thread) rebuilds a cache at a time. The holder removes
+# the lock file before releasing it, so none are left behind, and processes
+# that were waiting on a removed file lock a new one instead. Where file locks
+# aren't supported the lock is always acquired.
+# -------------------------------------------------------------------------------
+class CacheLock(object):
+
+    # --------------------------------
+    def __init__(self, file_path, blocking=True):
+        """ Acquires lock on cache file. If not blocking and lock is held
+        elsewhere, returns without it, check acquired() """
+        self._path = file_path + '.lock'
+        self._file = None
+        self._acquired = False
+        if fcntl is None:
+            self._acquired = True
+            return
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        while True:
+            try:
+                self._file = open(self._path, 'a')
+            except IOError:
+                # Can't create lock file, go on unlocked
+                self._acquired = True
+                return
+            try:
+                fcntl.flock(self._file.fileno(), flags)
+            except IOError:
+                self.release()
+                return
+            try:
+                if os.path.samestat(os.fstat(self._file.fileno()),
+                                    os.stat(self._path)):
+                    self._acquired = True
+                    return
+            except OSError:
+                pass
+            # Locked a file its holder removed meanwhile, retry
+            self._file.close()
+            self._file = None
+
+    # --------------------------------
+    def __enter__(self):
+        """ Context manager entry """
+        return self
+
+    # --------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Context manager exit, releases lock """
+        self.release()
+
+    # --------------------------------
+    def acquired(self):
+        """ Returns true if lock was acquired """
+        return self._acquired
+
+    # --------------------------------
+    def release(self):
+        """ Releases lock, if held, removing the lock file """
+        if self._file:
+            if self._acquired:
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    pass
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
 
 # -------------------------------------------------------------------------------
 # ScheduleParser
@@ -71,6 +207,12 @@ class Cache:
 # -------------------------------------------------------------------------------
 class ScheduleParser(object):
 
+    # --------------------------------
+    def __init__(self, stations=None):
+        """ Init parser, adding stations to given Station cache dict
+        (the class one otherwise) """
+        self._stations = stations
+
     # --------------------------------
     def make_schedule(self, is_weekday, is_northbound):
         """ Scan caltrain schedule web page and return schedule
@@ -158,36 +300,50 @@ class ScheduleParser(object):
                 # Got name, now get station times
                 if station_name:
                     times = self._parse_station_times_from_row(row)
-                    schedule.add_station_with_times(station_name, times)
+                    schedule.add_station_with_times(station_name, times,
+                                                    self._stations)
 
     # --------------------------------
     def _parse_station_times_from_row(self, row):
         """ Return Time object list by parsing schedule table row """
         debug("Parsing station times...")
-        times = []
-        hours_to_add = 0
-        morning = True
+        cells = []
         # Parse all row columns
         cols = row.findall('td')
         for c in cols:
-            tm = Time()
             # Try matching italic times (morning)
             time_text = self._find_element_tag_text(c, 'em')
             if time_text:
-                # If flipped from PM to AM, add 24 hours
-                if not morning:
-                    morning = not morning
-                    hours_to_add = 24
-                tm.set(time_text, hours_to_add)
+                cells.append((time_text, False))
             else:
                 # Try matching afternoon times (bold)
                 time_text = self._find_element_tag_text(c, 'strong')
-                if time_text:
+                cells.append((time_text, True) if time_text else None)
+        return ScheduleParser.make_times(cells)
+
+    # --------------------------------
+    @staticmethod
+    def make_times(cells):
+        """ Return Time object list for a station row's cells, each None
+        (no stop) or (hh:mm text, True if afternoon) """
+        times = []
+        hours_to_add = 0
+        morning = True
+        for cell in cells:
+            tm = Time()
+            if cell:
+                time_text, afternoon = cell
+                if not afternoon:
+                    # If flipped from PM to AM, add 24 hours
+                    if not morning:
+                        morning = not morning
+                        hours_to_add = 24
+                else:
                     # If flipped from AM to PM, add 12 hours
                     if morning:
                         morning = not morning
                         hours_to_add = 12
-                    tm.set(time_text, hours_to_add)
+                tm.set(time_text, hours_to_add)
             times.append(tm)
         return times
 
@@ -223,6 +379,9 @@ class ScheduleParser(object):
 # -------------------------------------------------------------------------------
 class Time(object):
 
+    # Date strptime assigns to parsed times, i.e. start of the schedule day
+    _day_start = datetime(1900, 1, 1)
+
     # --------------------------------
     def __init__(self):
         """ Default constructor """
@@ -284,6 +443,15 @@ class Time(object):
         """ Return timedelta obj difference with other time """
         return other._time - self._time
 
+    # --------------------------------
+    def minutes(self):
+        """ Return minutes since start of schedule day (past 24h for
+        after midnight times) or None if time is unknown """
+        if not self._time:
+            return None
+        delta = self._time - Time._day_start
+        return delta.days * 24 * 60 + delta.seconds // 60
+
 # -------------------------------------------------------------------------------
 # Location
 #
@@ -301,7 +469,11 @@ class Location(object):
         """ Default constructor """
         self._address = address
         self._dont_cache = dont_cache
-        self.set_lat_lon(lat, lon)
+        self._lat, self._lon = None, None
+        # Only cache known coords. A new location must not drop the cached
+        # coords of its address (nor touch a cache being rebuilt elsewhere)
+        if (lat, lon) != (None, None):
+            self.set_lat_lon(lat, lon)
 
     # --------------------------------
     def __str__(self):
@@ -321,14 +493,17 @@ class Location(object):
         return self._lat, self._lon
 
     # --------------------------------
-    def set_lat_lon(self, lat, lon):
-        """ Sets lat, lon. If set to None, removes location from cache """
+    def set_lat_lon(self, lat, lon, cache=None):
+        """ Sets lat, lon. If set to None, removes location from cache.
+        Cache is the geocode dict to use instead of the class one """
+        if cache is None:
+            cache = Location._geocode_cache
         self._lat, self._lon = lat, lon
         if (lat, lon) == (None, None):
-            if self._address in Location._geocode_cache:
-                del Location._geocode_cache[self._address]
+            if self._address in cache:
+                del cache[self._address]
         elif not self._dont_cache:
-            Location._geocode_cache[self._address] = lat, lon
+            cache[self._address] = lat, lon
 
     # --------------------------------
     def distance_to(self, other):
@@ -350,15 +525,18 @@ class Location(object):
         return dist
 
     # --------------------------------
-    def geocode(self):
+    def geocode(self, cache=None):
         """ Returns geocoded coords (cached or from Google).
         There is a 2500 query limit per day, may fail.
-        Google geocode license restricted to Google Maps """
+        Google geocode license restricted to Google Maps.
+        Cache is the geocode dict to use instead of the class one """
+        if cache is None:
+            cache = Location._geocode_cache
 
         # If found in cache, return coords
-        if self._address in Location._geocode_cache:
-            lat, lon = Location._geocode_cache[self._address]
-            self.set_lat_lon(lat, lon)
+        if self._address in cache:
+            lat, lon = cache[self._address]
+            self.set_lat_lon(lat, lon, cache)
             return
 
         # Real geocoding begins here
@@ -378,7 +556,7 @@ class Location(object):
                     if lat and lon:
                         # Successful
                         self.set_lat_lon(float(lat[0].text),
-                                         float(lon[0].text))
+                                         float(lon[0].text), cache)
                         return
                     else:
                         err = "couldn't resolve address to lat,lon. Try another."
@@ -399,15 +577,31 @@ class Location(object):
 
     # --------------------------------
     @staticmethod
-    def save_cache():
-        """ Saves cached location data into file """
-        Cache.put_file_objects(Location._geocode_cache_name, Location._geocode_cache)
+    def save_cache(cache=None):
+        """ Saves cached location data (or given geocode dict) into file """
+        if cache is None:
+            cache = Location._geocode_cache
+        Cache.put_file_objects(Location._geocode_cache_name, cache)
+
+    # --------------------------------
+    @staticmethod
+    def cache():
+        """ Returns class geocode dict """
+        return Location._geocode_cache
+
+    # --------------------------------
+    @staticmethod
+    def set_cache(cache):
+        """ Replaces class geocode dict (without mutating the old one) """
+        Location._geocode_cache = cache
 
 # -------------------------------------------------------------------------------
 # Station
 #
 # Represents a caltrain station.
-# Station objects are cached in the class to avoid duplication.
+# Station objects are cached in the class to avoid duplication. Static methods
+# take an optional stations dict to use instead of the class cache, so that a
+# new cache can be built while the class one is in use.
 # -------------------------------------------------------------------------------
 class Station(object):
 
@@ -415,11 +609,13 @@ class Station(object):
     _stations_cache = {}
 
     # --------------------------------
-    def __init__(self, name):
-        """ Init station location by adding search terms """
+    def __init__(self, name, lat=None, lon=None):
+        """ Init station location by adding search terms. Given coordinates
+        are used instead of geocoding, and not cached """
         self._name = name.lower().strip()
         address = self._name + " train station california"
-        self._location = Location(address=address)
+        self._location = Location(address=address, lat=lat, lon=lon,
+                                  dont_cache=lat is not None)
 
     # --------------------------------
     def __str__(self):
@@ -443,26 +639,57 @@ class Station(object):
 
     # --------------------------------
     @staticmethod
-    def find(name):
+    def find(name, stations=None):
         """ Retrieves station obj from cache or creates new obj """
+        if stations is None:
+            stations = Station._stations_cache
         name = name.lower().strip()
-        if name not in Station._stations_cache:
-            Station._stations_cache[name] = Station(name)
-        return Station._stations_cache[name]
+        if name not in stations:
+            stations[name] = Station(name)
+        return stations[name]
+
+    # --------------------------------
+    @staticmethod
+    def remember(station, stations=None):
+        """ Adds existing station obj to cache unless name already known """
+        if stations is None:
+            stations = Station._stations_cache
+        stations.setdefault(str(station), station)
 
     # --------------------------------
     @staticmethod
-    def forget(station_name):
+    def forget(station_name, stations=None):
         """ Removes named station from cache """
-        if station_name in Station._stations_cache:
-            del Station._stations_cache[station_name]
+        if stations is None:
+            stations = Station._stations_cache
+        if station_name in stations:
+            del stations[station_name]
+
+    # --------------------------------
+    @staticmethod
+    def cached_names(stations=None):
+        """ Returns names of all cached stations """
+        if stations is None:
+            stations = Station._stations_cache
+        return list(stations.keys())
+
+    # --------------------------------
+    @staticmethod
+    def geocode_all(stations=None, geocodes=None):
+        """ Cause all cached stations not yet geocoded to geocode, using
+        given geocode dict instead of the Location class one """
+        if stations is None:
+            stations = Station._stations_cache
+        for st_name in stations:
+            location = stations[st_name]._location
+            if not location.is_geocoded():
+                location.geocode(geocodes)
 
     # --------------------------------
     @staticmethod
-    def geocode_all():
-        """ Cause all cached stations to geocode """
-        for st_name in Station._stations_cache:
-            Station._stations_cache[st_name]._location.geocode()
+    def set_cache(stations):
+        """ Replaces class stations dict (without mutating the old one) """
+        Station._stations_cache = stations
 
 # -------------------------------------------------------------------------------
 # Schedule
@@ -476,6 +703,19 @@ class Station(object):
 # -------------------------------------------------------------------------------
 class Schedule(object):
 
+    # Departure table entry for minutes with no later departure
+    NO_DEPARTURE = 0xFFFF
+
+    # Optional next departure lookup tables, see build_departure_tables.
+    # Class default so schedules pickled without tables still load
+    _departure_tables = None
+
+    # Pre-rendered output of each station, see render
+    _rendered = None
+
+    # Arrive by indexes per origin, destination pair, see arrival_index
+    _arrival_indexes = None
+
     # --------------------------------
     def __init__(self, name):
         """ Default constructor """
@@ -494,12 +734,20 @@ class Schedule(object):
         return self._name
 
     # --------------------------------
-    def add_station_with_times(self, name, times):
-        """ Adds station (from cache) and times list to schedule """
-        st = Station.find(name)
+    def add_station_with_times(self, name, times, stations=None):
+        """ Adds station (from cache, or given stations dict) and times
+        list to schedule """
+        st = Station.find(name, stations)
         self._stations.append(st)
         self._times.append(times)
 
+    # --------------------------------
+    def remember_stations(self, stations=None):
+        """ Adds this schedule's station objs to Station cache, or to
+        given stations dict """
+        for st in self._stations:
+            Station.remember(st, stations)
+
     # --------------------------------
     def find_station(self, name):
         """ Returns station matching given name or None """
@@ -516,6 +764,11 @@ class Schedule(object):
             idx = self._stations.index(st)
             del self._stations[idx]
             del self._times[idx]
+            if self._departure_tables:
+                self._departure_tables.pop(str(st), None)
+            if self._rendered:
+                self._rendered.pop(str(st), None)
+            self._arrival_indexes = None
 
     # --------------------------------
     def find_nearest_station(self, location):
@@ -537,26 +790,70 @@ class Schedule(object):
         return map(str, self._stations)
 
     # --------------------------------
-    def print_details(self, single_station_name=None):
-        """ Print formatted schedule table and times """
-        print '-'*80
-        print self._name
-        print '-'*80
+    def render(self):
+        """ Pre-render text and JSON output blocks of each station, so
+        displaying the schedule needs no formatting """
+        rendered = {}
         for idx in xrange(len(self._stations)):
-            if single_station_name:
-                if not self._stations[idx].is_named(single_station_name):
-                    continue
-            print self._stations[idx]
+            name = str(self._stations[idx])
             # Gather all valid departures sorted ascending
             times = []
             for t in self._times[idx]:
                 if t.is_valid():
                     times.append(str(t))
             times.sort()
-            times = ", ".join(times)
-            for line in wrap(times, 72):      # As needed
-                print '\t', line
-        print
+            text = name + '\n'
+            for line in wrap(", ".join(times), 72):      # As needed
+                text += '\t' + line + '\n'
+            station_json = json.dumps(OrderedDict((('station', name),
+                                                   ('times', times))), indent=2)
+            rendered[name] = (text, Schedule._indent(station_json, 6))
+        self._rendered = rendered
+
+    # --------------------------------
+    def is_rendered(self):
+        """ Returns true if output blocks were pre-rendered """
+        return self._rendered is not None
+
+    # --------------------------------
+    def rendered_text(self, single_station_name=None):
+        """ Return formatted schedule table and times """
+        if self._rendered is None:
+            self.render()
+        text = ['-'*80, '\n', self._name, '\n', '-'*80, '\n']
+        for name in self._rendered_names(single_station_name):
+            text.append(self._rendered[name][0])
+        text.append('\n')
+        return ''.join(text)
+
+    # --------------------------------
+    def rendered_json(self, single_station_name=None):
+        """ Return schedule stations and times as indented JSON object """
+        if self._rendered is None:
+            self.render()
+        blocks = [self._rendered[name][1] for name in
+                  self._rendered_names(single_station_name)]
+        return '  {\n    "schedule": %s, \n    "stations": [\n%s\n    ]\n  }' % (
+                    json.dumps(self._name), ', \n'.join(blocks))
+
+    # --------------------------------
+    def print_details(self, single_station_name=None):
+        """ Print formatted schedule table and times """
+        sys.stdout.write(self.rendered_text(single_station_name))
+
+    # --------------------------------
+    def _rendered_names(self, single_station_name=None):
+        """ Return names of stations to display, in schedule order """
+        if single_station_name:
+            name = single_station_name.lower().strip()
+            return [name] if name in self._rendered else []
+        return map(str, self._stations)
+
+    # --------------------------------
+    @staticmethod
+    def _indent(text, spaces):
+        """ Return text with all lines indented by spaces """
+        return '\n'.join(' ' * spaces + line for line in text.split('\n'))
 
     # --------------------------------
     def is_valid_direction(self, orig_name, dest_name):
@@ -569,19 +866,197 @@ class Schedule(object):
             return False
 
     # --------------------------------
-    def get_earliest(self, when, orig_name, dest_name):
-        """ Return earliest route from origin to destination """
+    def departure_boundaries(self, orig_name, dest_name):
+        """ Return sorted origin departure minutes of trains serving both
+        origin and destination. Route query results for the pair can only
+        change when the query minute crosses one of these """
+        boundaries = []
+        if self.is_valid_direction(orig_name, dest_name):
+            st_names = self.list_stations()
+            orig_times = self._times[st_names.index(orig_name)]
+            dest_times = self._times[st_names.index(dest_name)]
+            for i in xrange(len(orig_times)):
+                if orig_times[i].is_valid() and dest_times[i].is_valid():
+                    boundaries.append(orig_times[i].minutes())
+            boundaries.sort()
+        return boundaries
+
+    # --------------------------------
+    def station_minutes(self, name):
+        """ Return named station's times as minutes per train column,
+        None where the train doesn't stop """
+        idx = self.list_stations().index(name)
+        return [t.minutes() for t in self._times[idx]]
+
+    # --------------------------------
+    def train_signatures(self, renamed=None):
+        """ Return list of trains (columns), each a tuple of (station name,
+        minutes) stops. Renamed dict maps station names to report instead """
+        renamed = renamed or {}
+        st_names = [renamed.get(n, n) for n in self.list_stations()]
+        num_cols = max(len(times) for times in self._times) if self._times else 0
+        trains = []
+        for col in xrange(num_cols):
+            stops = []
+            for idx in xrange(len(st_names)):
+                if col < len(self._times[idx]) and self._times[idx][col].is_valid():
+                    stops.append((st_names[idx], self._times[idx][col].minutes()))
+            if stops:
+                trains.append(tuple(stops))
+        return trains
+
+    # --------------------------------
+    def build_departure_tables(self, reuse_from=None):
+        """ Build per-station tables with one entry per minute of the
+        service day, holding the column of the next train departing at or
+        after that minute. Trains ending at a station don't depart from it.
+        Tables of stations with unchanged departures are taken from the
+        reuse_from schedule if given """
+        old_names = reuse_from.list_stations() if reuse_from else []
+        old_tables = reuse_from._departure_tables if reuse_from else None
+        tables = {}
+        for idx in xrange(len(self._stations)):
+            name = str(self._stations[idx])
+            signature = self._departure_signature(idx)
+            if old_tables and name in old_tables and \
+                    reuse_from._departure_signature(old_names.index(name)) == signature:
+                tables[name] = old_tables[name]
+                continue
+            departures = [(minute, col) for col, minute in enumerate(signature)
+                          if minute is not None]
+            departures.sort()
+            size = departures[-1][0] + 1 if departures else 0
+            table = array('H', [Schedule.NO_DEPARTURE]) * size
+            # Fill backwards so each minute points at the next departure
+            next_col = Schedule.NO_DEPARTURE
+            pending = len(departures) - 1
+            for minute in xrange(size - 1, -1, -1):
+                while pending >= 0 and departures[pending][0] >= minute:
+                    next_col = departures[pending][1]
+                    pending -= 1
+                table[minute] = next_col
+            tables[name] = table
+        self._departure_tables = tables
+
+    # --------------------------------
+    def has_departure_tables(self):
+        """ Returns true if departure tables were built """
+        return self._departure_tables is not None
+
+    # --------------------------------
+    def departure_tables_size(self):
+        """ Returns bytes used by departure table entries """
+        if not self._departure_tables:
+            return 0
+        return sum(len(t) * t.itemsize for t in self._departure_tables.values())
+
+    # --------------------------------
+    def memory_roots(self):
+        """ Return dict of objects held by this schedule, by memory report
+        component """
+        return {'time_cells' : [t for times in self._times for t in times],
+                'stations' : self._stations,
+                'departure_tables' : [self._departure_tables],
+                'arrival_indexes' : [self._arrival_indexes],
+                'rendered' : [self._rendered]}
+
+    # --------------------------------
+    def next_departure(self, minute, station_name):
+        """ Return column of next train departing station at or after
+        given minute of the service day, or None. Uses departure tables
+        if built """
+        if self._departure_tables is not None:
+            table = self._departure_tables.get(station_name)
+            if table is None or minute >= len(table):
+                return None
+            col = table[minute]
+            return None if col == Schedule.NO_DEPARTURE else col
+        # No tables, scan station times
+        st_names = self.list_stations()
+        if station_name not in st_names:
+            return None
+        idx = st_names.index(station_name)
+        next_col = None
+        for col in xrange(len(self._times[idx])):
+            tm = self._times[idx][col]
+            if tm.is_valid() and self._has_later_stop(idx, col):
+                if tm.minutes() >= minute:
+                    if next_col is None or tm < self._times[idx][next_col]:
+                        next_col = col
+        return next_col
+
+    # --------------------------------
+    def departures(self, station_name):
+        """ Return (minutes, column, departure time, last station, its
+        time) of trains departing named station, sorted by departure, as
+        departure board rows need them. Empty if station not in schedule """
+        st_names = self.list_stations()
+        if station_name not in st_names:
+            return []
+        idx = st_names.index(station_name)
+        terminals = self._train_terminals()
+        return sorted((minute, col, str(self._times[idx][col]),
+                       str(terminals[col][0]), str(terminals[col][1]))
+                      for col, minute in enumerate(self._departure_signature(idx))
+                      if minute is not None)
+
+    # --------------------------------
+    def _train_terminals(self):
+        """ Return last station and its Time of the train in each column,
+        found in a single pass from the last station up """
+        num_cols = len(self._times[0]) if self._times else 0
+        terminals = [(None, None)] * num_cols
+        pending = num_cols
+        for idx in xrange(len(self._stations) - 1, -1, -1):
+            if not pending:
+                break
+            for col in xrange(num_cols):
+                if terminals[col][0] is None and self._times[idx][col].is_valid():
+                    terminals[col] = (self._stations[idx], self._times[idx][col])
+                    pending -= 1
+        return terminals
+
+    # --------------------------------
+    def station_time(self, station_name, col):
+        """ Return time string of station in given train column """
+        idx = self.list_stations().index(station_name)
+        return str(self._times[idx][col])
+
+    # --------------------------------
+    def _departure_signature(self, idx):
+        """ Return departure minutes per train column for station index,
+        None where the train doesn't depart. Departure tables only depend
+        on this """
+        signature = []
+        for col in xrange(len(self._times[idx])):
+            tm = self._times[idx][col]
+            if tm.is_valid() and self._has_later_stop(idx, col):
+                signature.append(tm.minutes())
+            else:
+                signature.append(None)
+        return signature
+
+    # --------------------------------
+    def _has_later_stop(self, idx, col):
+        """ Returns true if train in column stops after station index """
+        for times in self._times[idx + 1:]:
+            if times[col].is_valid():
+                return True
+        return False
+
+    # --------------------------------
+    def get_earliest(self, minute, orig_name, dest_name):
+        """ Return earliest route from origin to destination departing at
+        or after given minute of the service day """
         earliest = None
         if self.is_valid_direction(orig_name, dest_name):
             st_names = self.list_stations()
-            cur_time = Time()
-            cur_time.set(when.strftime("%I:%M"), 12 if when.time().hour >= 12 else 0)
             orig_times = self._times[st_names.index(orig_name)]
             dest_times = self._times[st_names.index(dest_name)]
             for i in xrange(len(orig_times)):
                 if orig_times[i].is_valid() and dest_times[i].is_valid():
                     # If origin time less than current, skip times
-                    if orig_times[i] < cur_time:
+                    if orig_times[i].minutes() < minute:
                         continue
                     # Save earliest of all matches
                     if not earliest:
@@ -591,8 +1066,54 @@ class Schedule(object):
         return str(earliest) if earliest else None
 
     # --------------------------------
-    def get_fastest(self, when, orig_name, dest_name, all):
-        """ Return fastest routes from origin to destination. If
+    def arrival_index(self, orig_name, dest_name):
+        """ Return arrive by index of trains from origin to destination:
+        arrival minutes sorted ascending, and per arrival the column of the
+        latest departing train among those arriving by then. Expresses
+        overtake locals, so that's not always the train arriving last.
+        Built on first use of each pair """
+        indexes = self._arrival_indexes
+        if indexes is None:
+            indexes = self._arrival_indexes = {}
+        index = indexes.get((orig_name, dest_name))
+        if index is None:
+            trips = []
+            if self.is_valid_direction(orig_name, dest_name):
+                st_names = self.list_stations()
+                orig_times = self._times[st_names.index(orig_name)]
+                dest_times = self._times[st_names.index(dest_name)]
+                for col in xrange(len(orig_times)):
+                    if orig_times[col].is_valid() and dest_times[col].is_valid():
+                        trips.append((dest_times[col].minutes(),
+                                      orig_times[col].minutes(), col))
+            trips.sort()
+            arrivals, latest = array('H'), array('H')
+            latest_departure = None
+            for arrival, departure, col in trips:
+                if latest_departure is None or departure > latest_departure:
+                    latest_departure, latest_col = departure, col
+                arrivals.append(arrival)
+                latest.append(latest_col)
+            index = indexes[(orig_name, dest_name)] = (arrivals, latest)
+        return index
+
+    # --------------------------------
+    def get_arrive_by(self, minute, orig_name, dest_name):
+        """ Return departure and arrival times of latest departing train
+        from origin arriving at destination by given minute of the service
+        day (past 24h for after midnight), or None """
+        arrivals, latest = self.arrival_index(orig_name, dest_name)
+        pos = bisect_right(arrivals, minute)
+        if not pos:
+            return None
+        col = latest[pos - 1]
+        return OrderedDict((('departure', self.station_time(orig_name, col)),
+                            ('arrival', self.station_time(dest_name, col))))
+
+    # --------------------------------
+    def get_fastest(self, minute, orig_name, dest_name, all):
+        """ Return fastest routes from origin to destination departing at
+        or after given minute of the service day. If
         all is true, returns a list of lists of durations and
         lists of departure times for each duration. If all is
         false returns the single fastest time and duration """
@@ -601,12 +1122,10 @@ class Schedule(object):
             st_names = self.list_stations()
             orig_times = self._times[st_names.index(orig_name)]
             dest_times = self._times[st_names.index(dest_name)]
-            cur_time = Time()
-            cur_time.set(when.strftime("%I:%M"), 12 if when.time().hour >= 12 else 0)
             for i in xrange(len(orig_times)):
                 if orig_times[i].is_valid() and dest_times[i].is_valid():
                     # If origin time less than current, skip times
-                    if orig_times[i] < cur_time:
+                    if orig_times[i].minutes() < minute:
                         continue
                     delta = orig_times[i].time_delta(dest_times[i])
                     if delta not in durations:
@@ -626,6 +1145,596 @@ class Schedule(object):
         else:
             return None
 
+# -------------------------------------------------------------------------------
+# ScheduleDiff
+#
+# Changes between a cached schedule and a newly parsed one: stations added,
+# removed or renamed, stations whose times changed and trains added or
+# removed. The timetable has no train ids, so trains are matched by their stops
+# and a station counts as renamed if it kept identical times. Station times are
+# compared regardless of column, since adding a train shifts all columns.
+# -------------------------------------------------------------------------------
+class ScheduleDiff(object):
+
+    # --------------------------------
+    def __init__(self, old, new):
+        """ Diff old schedule (None if there was none) with new one """
+        self._name = new.name()
+        self._is_initial = old is None
+        old_names = old.list_stations() if old else []
+        new_names = new.list_stations()
+        self.added = [n for n in new_names if n not in old_names]
+        self.removed = [n for n in old_names if n not in new_names]
+        self.renamed = []
+        for name in list(self.removed):
+            minutes = ScheduleDiff._stops(old, name)
+            for new_name in self.added:
+                if ScheduleDiff._stops(new, new_name) == minutes:
+                    self.renamed.append((name, new_name))
+                    self.removed.remove(name)
+                    self.added.remove(new_name)
+                    break
+        self.changed = [n for n in new_names if n in old_names and
+                        ScheduleDiff._stops(old, n) != ScheduleDiff._stops(new, n)]
+        # Station order decides valid directions
+        self.reordered = [n for n in old_names if n in new_names] != \
+                         [n for n in new_names if n in old_names]
+        old_trains = Counter(old.train_signatures(dict(self.renamed))) \
+                        if old else Counter()
+        new_trains = Counter(new.train_signatures())
+        self.added_trains = sorted((new_trains - old_trains).elements())
+        self.removed_trains = sorted((old_trains - new_trains).elements())
+
+    # --------------------------------
+    def __str__(self):
+        """ Return text change report """
+        if self._is_initial:
+            return "%s: new, %s stations, %s trains" % (self._name,
+                        len(self.added), len(self.added_trains))
+        if self.is_empty():
+            return "%s: unchanged" % self._name
+        lines = ["%s:" % self._name]
+        for title, names in (("added stations", self.added),
+                             ("removed stations", self.removed),
+                             ("changed stations", self.changed)):
+            if names:
+                lines.append("\t%s: %s" % (title, ", ".join(names)))
+        if self.renamed:
+            lines.append("\trenamed stations: %s" % ", ".join(
+                            "%s -> %s" % r for r in self.renamed))
+        if self.reordered:
+            lines.append("\tstation order changed")
+        for title, trains in (("added train", self.added_trains),
+                              ("removed train", self.removed_trains)):
+            for train in trains:
+                lines.append("\t%s: %s" % (title, ScheduleDiff._describe(train)))
+        return "\n".join(lines)
+
+    # --------------------------------
+    def is_empty(self):
+        """ Returns true if schedules are identical """
+        return not (self._is_initial or self.added or self.removed or
+                    self.renamed or self.changed or self.reordered or
+                    self.added_trains or self.removed_trains)
+
+    # --------------------------------
+    def affected_stations(self):
+        """ Returns names of stations whose routes may have changed, or
+        None if all of them may have """
+        if self._is_initial or self.reordered:
+            return None
+        affected = set(self.added + self.removed)
+        for old_name, new_name in self.renamed:
+            affected.update((old_name, new_name))
+        # A station pair's routes only change if a train stopping there did
+        for train in self.added_trains + self.removed_trains:
+            affected.update(st_name for st_name, minutes in train)
+        return affected
+
+    # --------------------------------
+    def to_dict(self):
+        """ Returns report as dict, suitable for JSON """
+        return {'schedule' : self._name,
+                'initial' : self._is_initial,
+                'added' : self.added,
+                'removed' : self.removed,
+                'renamed' : self.renamed,
+                'changed' : self.changed,
+                'reordered' : self.reordered,
+                'added_trains' : map(ScheduleDiff._describe, self.added_trains),
+                'removed_trains' : map(ScheduleDiff._describe, self.removed_trains)}
+
+    # --------------------------------
+    @staticmethod
+    def _stops(schedule, st_name):
+        """ Return sorted stop minutes of named station in schedule """
+        return sorted(m for m in schedule.station_minutes(st_name) if m is not None)
+
+    # --------------------------------
+    @staticmethod
+    def _describe(train):
+        """ Return first and last stops text of train signature """
+        def stop(st_name, minutes):
+            return "%s %02d:%02d" % (st_name, (minutes // 60) % 24, minutes % 60)
+        return "%s - %s" % (stop(*train[0]), stop(*train[-1]))
+
+# -------------------------------------------------------------------------------
+# Timetable
+#
+# One version of the caltrain timetable: the four schedules (weekday, weekend,
+# northbound, southbound) and the dates it is effective from and to. Either
+# date may be None for an open-ended range.
+# -------------------------------------------------------------------------------
+class Timetable(object):
+
+    # --------------------------------
+    def __init__(self, schedules, effective_from=None, effective_to=None):
+        """ Init from weekday nb, weekday sb, weekend nb, weekend sb schedules """
+        (self._weekday_northbound,
+        self._weekday_southbound,
+        self._weekend_northbound,
+        self._weekend_southbound) = schedules
+        self._effective_from = effective_from
+        self._effective_to = effective_to
+
+    # --------------------------------
+    def __str__(self):
+        """ Return string representation """
+        return "Timetable effective %s to %s" % (self._effective_from or "-",
+                                                 self._effective_to or "-")
+
+    # --------------------------------
+    def version(self):
+        """ Return version id, the effective from date (None if unbounded) """
+        return self._effective_from
+
+    # --------------------------------
+    def schedules(self):
+        """ Return tuple of all four schedules, as kept in cache files """
+        return (self._weekday_northbound, self._weekday_southbound,
+                self._weekend_northbound, self._weekend_southbound)
+
+    # --------------------------------
+    def day_schedules(self, when):
+        """ Returns northbound and southbound schedules for given day """
+        if when.weekday() >= 5:
+            nb = self._weekend_northbound   # Sat - Sun
+            sb = self._weekend_southbound
+        else:
+            nb = self._weekday_northbound   # Mon - Fri
+            sb = self._weekday_southbound
+        return nb, sb
+
+    # --------------------------------
+    def list_stations(self):
+        """ Return sorted list of all stations from all schedules """
+        all = []
+        for schedule in self.schedules():
+            all += schedule.list_stations()
+        return sorted(list(set(all)))
+
+    # --------------------------------
+    def build_derived_data(self, departure_tables):
+        """ Pre-renders output and, if asked, builds departure tables of
+        schedules lacking them. Returns true if anything was built """
+        built = False
+        for schedule in self.schedules():
+            if not schedule.is_rendered():
+                schedule.render()
+                built = True
+            if departure_tables and not schedule.has_departure_tables():
+                schedule.build_departure_tables()
+                built = True
+        if built:
+            debug("Departure tables use %s bytes" % self.departure_tables_size())
+        return built
+
+    # --------------------------------
+    def departure_tables_size(self):
+        """ Returns bytes used by departure tables of all schedules """
+        return sum(s.departure_tables_size() for s in self.schedules())
+
+# -------------------------------------------------------------------------------
+# TimetableRegistry
+#
+# Tracks timetable versions by effective date. The current version lives in the
+# route cache file, older ones are archived to their own cache files when a
+# rebuild replaces the timetable. An index file lists each version's dates and
+# file. Versions other than the current one are loaded only when a query date
+# needs them.
+# -------------------------------------------------------------------------------
+class TimetableRegistry(object):
+
+    _index_file_name = "caltrain_timetable_index.txt"
+
+    # --------------------------------
+    def __init__(self, current_file_path):
+        """ Default constructor """
+        self._current_file_path = current_file_path
+        self._loaded = {}
+        self._set_versions([(None, None, current_file_path)])
+
+    # --------------------------------
+    def load_index(self):
+        """ Reads version index file, assumes a single version without one """
+        versions = Cache.get_file_objects(TimetableRegistry._index_file_name)
+        self._set_versions(versions or [(None, None, self._current_file_path)])
+        self._loaded = {}
+
+    # --------------------------------
+    def current(self):
+        """ Returns current timetable, None if not set """
+        return self._loaded.get(self._current_file_path)
+
+    # --------------------------------
+    def set_current(self, schedules):
+        """ Makes schedules the current timetable, keeping its dates """
+        effective_from, effective_to, path = self._current_version()
+        self._loaded[path] = Timetable(schedules, effective_from, effective_to)
+        return self._loaded[path]
+
+    # --------------------------------
+    def add_version(self, schedules, effective_from):
+        """ Adds schedules as the timetable effective from given date until
+        the next version starts, clipping the version before it to end the
+        day before. A version later than the current timetable becomes
+        current, archiving the current one. An earlier one is archived,
+        unless it's the same as the version already effective then. A
+        version starting on the same date is replaced. Returns the current
+        timetable. The index is only written by save_index, so that it's
+        written after the current cache file """
+        old = self.current()
+        old_from, old_to, path = self._current_version()
+        versions = [v for v in self._versions if v[2] != path]
+        if not old and not versions:
+            # First timetable ever, effective for any earlier date too
+            self._set_versions([(None, None, path)])
+            return self.set_current(schedules)
+        archived = None
+        if old and old_from is not None and effective_from < old_from:
+            # Earlier than the current timetable, archive between versions
+            existing = self.find(effective_from)
+            if all(ScheduleDiff(e, n).is_empty()
+                   for e, n in zip(existing.schedules(), schedules)):
+                return old
+            new_path = self._archive_path(effective_from)
+            Cache.put_file_objects(new_path, schedules)
+            versions.append((old_from, old_to, path))
+        else:
+            if old and old_from != effective_from:
+                # Later than the current timetable, archive the current one
+                archived = self._archive_path(old_from)
+                Cache.put_file_objects(archived, old.schedules())
+                versions.append((old_from, old_to, archived))
+            new_path = path
+
+        # Replace version starting on the same date, clip the one before
+        versions = [v for v in versions if v[0] != effective_from]
+        later = [v[0] for v in versions if v[0] and v[0] > effective_from]
+        effective_to = min(later) - timedelta(days=1) if later else None
+        clipped = []
+        for v_from, v_to, v_path in versions:
+            if (v_from or date.min) < effective_from and \
+                    (v_to is None or v_to >= effective_from):
+                v_to = effective_from - timedelta(days=1)
+            clipped.append((v_from, v_to, v_path))
+        clipped.append((effective_from, effective_to, new_path))
+        self._set_versions(clipped)
+
+        # Loaded timetables keep their dates, others reload when needed
+        loaded = {new_path : Timetable(schedules, effective_from, effective_to)}
+        if archived:
+            loaded[archived] = Timetable(old.schedules(), old_from,
+                                         effective_from - timedelta(days=1))
+        elif old and new_path != path:
+            loaded[path] = old
+        self._loaded = loaded
+        return self.current()
+
+    # --------------------------------
+    def save_index(self):
+        """ Writes version index file """
+        Cache.put_file_objects(TimetableRegistry._index_file_name, self._versions)
+
+    # --------------------------------
+    def find(self, on_date):
+        """ Returns timetable effective on given date, loading it from its
+        cache file if needed. Dates before all versions use the oldest, and
+        versions whose file is lost fall back to the current timetable """
+        idx = max(bisect_right(self._starts, on_date) - 1, 0)
+        effective_from, effective_to, path = self._versions[idx]
+        if path not in self._loaded:
+            schedules = Cache.get_file_objects(path)
+            if not schedules:
+                return self.current()
+            debug("Loaded timetable version from %s" % path)
+            self._loaded[path] = Timetable(schedules, effective_from, effective_to)
+        return self._loaded[path]
+
+    # --------------------------------
+    def versions(self):
+        """ Returns list of (effective from, effective to, file path) """
+        return list(self._versions)
+
+    # --------------------------------
+    def loaded_timetables(self):
+        """ Returns timetables loaded so far, current and archived """
+        return self._loaded.values()
+
+    # --------------------------------
+    def _archive_path(self, effective_from):
+        """ Returns cache file path of version effective from given date """
+        root, ext = os.path.splitext(self._current_file_path)
+        return "%s_%s%s" % (root, effective_from.strftime("%Y%m%d")
+                            if effective_from else "initial", ext)
+
+    # --------------------------------
+    def _current_version(self):
+        """ Returns index entry of the current timetable """
+        for version in self._versions:
+            if version[2] == self._current_file_path:
+                return version
+        return (None, None, self._current_file_path)
+
+    # --------------------------------
+    def _set_versions(self, versions):
+        """ Sets versions list, sorted by effective from date """
+        self._versions = sorted(versions, key=lambda v: v[0] or date.min)
+        self._starts = [v[0] or date.min for v in self._versions]
+
+# -------------------------------------------------------------------------------
+# QueryCache
+#
+# LRU cache of route query results. A query result for a given schedule, origin
+# and destination only changes when the query time crosses a departure, so each
+# entry keeps the pair's departure boundaries and one result per interval
+# between them. Any query time within a cached interval is a hit.
+# Safe to share between threads.
+# -------------------------------------------------------------------------------
+class QueryCache(object):
+
+    DEFAULT_SIZE = 256
+
+    # --------------------------------
+    def __init__(self, max_entries=DEFAULT_SIZE):
+        """ Default constructor """
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self.clear()
+
+    # --------------------------------
+    def clear(self):
+        """ Drops all cached results and resets counters """
+        with self._lock:
+            self._entries = OrderedDict()
+            self._hits = 0
+            self._misses = 0
+
+    # --------------------------------
+    def copy(self):
+        """ Returns new cache holding the current results """
+        other = QueryCache(self._max_entries)
+        with self._lock:
+            for key, (boundaries, results) in self._entries.items():
+                other._entries[key] = (boundaries, dict(results))
+        return other
+
+    # --------------------------------
+    def invalidate(self, version, schedule_name=None, station_names=None):
+        """ Drops results of timetable version's schedule involving any of
+        given stations, or all of the schedule's results if none given.
+        Drops all of the version's results if no schedule is given """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key[0] != version or \
+                        schedule_name is not None and key[1] != schedule_name:
+                    continue
+                if station_names is None or key[2] in station_names or \
+                        key[3] in station_names:
+                    del self._entries[key]
+
+    # --------------------------------
+    def get(self, version, schedule, minute, orig_name, dest_name, query,
+            compute):
+        """ Returns cached result for query at given minute of the service
+        day on timetable version's schedule, calling compute() on a miss.
+        Query names the kind of result (earliest, fastest, etc) """
+        key = (version, schedule.name(), orig_name, dest_name, query)
+        with self._lock:
+            # Most recently used entries are kept last, evict from the front
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        if entry is None:
+            # Scan schedule outside the lock, other queries needn't wait for it
+            boundaries = schedule.departure_boundaries(orig_name, dest_name)
+        with self._lock:
+            if entry is None:
+                # Another query may have added the entry meanwhile, use it
+                entry = self._entries.pop(key, None) or (boundaries, {})
+                self._entries[key] = entry
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+            boundaries, results = entry
+            interval = bisect_left(boundaries, minute)
+            if interval in results:
+                self._hits += 1
+                return results[interval]
+            self._misses += 1
+        # Compute outside the lock, other queries needn't wait for it
+        result = compute()
+        with self._lock:
+            results[interval] = result
+        return result
+
+    # --------------------------------
+    def stats(self):
+        """ Returns dict of entry count, hits, misses and hit rate """
+        with self._lock:
+            total = self._hits + self._misses
+            return {'entries' : len(self._entries),
+                    'hits' : self._hits,
+                    'misses' : self._misses,
+                    'hit_rate' : float(self._hits) / total if total else 0.0}
+
+# -------------------------------------------------------------------------------
+# MemoryReport
+#
+# Memory held by planner data, by component. Each component's objects are
+# deep sized with sys.getsizeof, following containers and instance dicts.
+# Objects reachable from several components are counted once, in the first
+# component sized, so derived data and time cells are sized before the
+# schedules referencing them. Traced allocations are added when tracing with
+# tracemalloc, from the pytracemalloc package.
+# -------------------------------------------------------------------------------
+class MemoryReport(object):
+
+    # Components in sizing order
+    COMPONENTS = ('departure_tables', 'arrival_indexes', 'rendered',
+                  'time_cells', 'stations', 'schedules', 'geocode_cache',
+                  'query_cache')
+
+    # --------------------------------
+    def __init__(self, snapshot):
+        """ Sizes all data of given planner snapshot """
+        roots = dict((name, []) for name in MemoryReport.COMPONENTS)
+        registry = snapshot.registry()
+        for timetable in registry.loaded_timetables():
+            for schedule in timetable.schedules():
+                for name, objs in schedule.memory_roots().items():
+                    roots[name].extend(objs)
+                roots['schedules'].append(schedule)
+            roots['schedules'].append(timetable)
+        roots['schedules'].append(registry)
+        roots['stations'].append(snapshot.stations())
+        roots['geocode_cache'].append(snapshot.geocodes())
+        roots['query_cache'].append(snapshot.query_cache())
+        seen = set()
+        self._components = OrderedDict()
+        for name in MemoryReport.COMPONENTS:
+            self._components[name] = MemoryReport.deep_size(roots[name], seen)
+
+    # --------------------------------
+    def total(self):
+        """ Returns bytes of all components """
+        return sum(size for size, count in self._components.values())
+
+    # --------------------------------
+    def to_dict(self):
+        """ Returns report dict of bytes and object counts per component,
+        total bytes, traced and peak resident bytes (None if unknown) """
+        components = OrderedDict()
+        for name, (size, count) in self._components.items():
+            components[name] = OrderedDict((('bytes', size),
+                                            ('objects', count)))
+        return OrderedDict((('components', components),
+                            ('total_bytes', self.total()),
+                            ('traced', MemoryReport.traced()),
+                            ('peak_rss_bytes', MemoryReport.peak_rss())))
+
+    # --------------------------------
+    @staticmethod
+    def deep_size(objs, seen):
+        """ Returns bytes and count of given objects and all they reference,
+        skipping and adding to seen the ids of objects already sized """
+        size, count = 0, 0
+        pending = list(objs)
+        while pending:
+            obj = pending.pop()
+            if obj is None or id(obj) in seen or isinstance(obj, type):
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            count += 1
+            if isinstance(obj, dict):
+                pending.extend(obj.keys())
+                pending.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                pending.extend(obj)
+            if hasattr(obj, '__dict__'):
+                pending.append(obj.__dict__)
+        return size, count
+
+    # --------------------------------
+    @staticmethod
+    def traced():
+        """ Returns dict of current and peak traced bytes, or None if not
+        tracing """
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        return OrderedDict((('current_bytes', current), ('peak_bytes', peak)))
+
+    # --------------------------------
+    @staticmethod
+    def peak_rss():
+        """ Returns peak resident bytes of this process, or None """
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on Mac OS X, KB elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+# -------------------------------------------------------------------------------
+# PlannerSnapshot
+#
+# All data route planning reads: the timetable registry and current timetable,
+# the query result cache, the station and geocode caches and the change report
+# of the build that made it. Built in one go and not changed once published
+# (other than through the thread safe query cache and lazy timetable loads), so
+# a planner swaps in new data with a single reference assignment and queries
+# see either the old or the new snapshot, never a mix.
+# -------------------------------------------------------------------------------
+class PlannerSnapshot(object):
+
+    # --------------------------------
+    def __init__(self, registry, timetable, query_cache, stations, geocodes,
+                 changes):
+        """ Default constructor """
+        self._registry = registry
+        self._timetable = timetable
+        self._query_cache = query_cache
+        self._stations = stations
+        self._geocodes = geocodes
+        self._changes = changes
+
+    # --------------------------------
+    def registry(self):
+        """ Returns timetable registry """
+        return self._registry
+
+    # --------------------------------
+    def timetable(self):
+        """ Returns current timetable """
+        return self._timetable
+
+    # --------------------------------
+    def timetable_on(self, on_date):
+        """ Returns timetable effective on given date, or current if None """
+        if on_date is None:
+            return self._timetable
+        return self._registry.find(on_date)
+
+    # --------------------------------
+    def query_cache(self):
+        """ Returns query result cache """
+        return self._query_cache
+
+    # --------------------------------
+    def stations(self):
+        """ Returns station objects dict, by name """
+        return self._stations
+
+    # --------------------------------
+    def geocodes(self):
+        """ Returns geocode dict, address -> lat, lon """
+        return self._geocodes
+
+    # --------------------------------
+    def changes(self):
+        """ Returns schedule diffs of the build, empty if loaded from cache """
+        return self._changes
+
 # -------------------------------------------------------------------------------
 # RoutePlanner
 #
@@ -634,81 +1743,334 @@ class Schedule(object):
 # Builds schedules using parser.
 # Some caltrain schedule caveats are not yet represented, like "saturday only"
 # trains, but can be extended to do so.
+# Planner data is held in a PlannerSnapshot. It can be rebuilt in a background
+# thread while queries keep using the current snapshot, then swapped in.
 # -------------------------------------------------------------------------------
 class RoutePlanner(object):
 
+    # Times before this hour belong to the previous day's service, as the
+    # after midnight part of its schedules
+    SERVICE_DAY_START_HOUR = 3
+
+    # Default minutes between times of a sweep window
+    SWEEP_STEP_MINUTES = 15
+
+    _cache_file_path = 'caltrain_route_cache.txt'
+
+    # --------------------------------
+    def __init__(self, query_cache_size=QueryCache.DEFAULT_SIZE,
+                 memory_budget=None, memory_limit=None):
+        """ Default constructor. If memory budget (MB) is given, loading
+        data using more warns. Data using more than memory limit (MB)
+        fails to load """
+        self._query_cache_size = query_cache_size
+        self._memory_budget = memory_budget
+        self._memory_limit = memory_limit
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_error = None
+
     # --------------------------------
-    def load(self, rebuild_cache = False):
+    def load(self, rebuild_cache = False, departure_tables = False,
+             effective_date = None):
         """ Create all objects needed for route planning. This method
-        should be called when preparing to use the route planner. """
+        should be called when preparing to use the route planner.
+        If departure_tables is true, per-minute next departure tables are
+        built (once, then kept in the cache file) for next_departure and
+        departure boards.
+        A rebuilt timetable that changed becomes a new version, effective
+        from given date (today otherwise). """
         debug("RoutePlanner.load, rebuild cache: %s" % rebuild_cache)
-        self._cache_file_path = 'caltrain_route_cache.txt'
+        snapshot = self._build_snapshot(rebuild_cache, departure_tables,
+                                        effective_date)
+        self._check_memory(snapshot)
+        self._publish(snapshot)
 
-        # Load schedules cache file
-        if rebuild_cache:
-            cache_objects = None
-        else:
-            cache_objects = Cache.get_file_objects(self._cache_file_path)
-        if cache_objects:
+    # --------------------------------
+    def load_schedules(self, schedules, departure_tables = False):
+        """ Use given weekday nb, weekday sb, weekend nb, weekend sb
+        schedules as the current timetable, instead of loading. No cache
+        files are read or written, so made up timetables can be queried """
+        stations = {}
+        for schedule in schedules:
+            schedule.remember_stations(stations)
+        registry = TimetableRegistry(self._cache_file_path)
+        timetable = registry.set_current(schedules)
+        timetable.build_derived_data(departure_tables)
+        self._publish(PlannerSnapshot(registry, timetable,
+                                      QueryCache(self._query_cache_size),
+                                      stations, dict(Location.cache()), []))
+
+    # --------------------------------
+    def refresh(self, departure_tables = False, effective_date = None):
+        """ Rebuilds planner data like load with rebuild_cache, but in a
+        background thread. Queries keep using current data until the new
+        data is complete and swapped in. Returns the refresh thread, or the
+        running one if a refresh is already in progress. The planner must
+        have been loaded first """
+        with self._refresh_lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return self._refresh_thread
+            self._refresh_error = None
+            self._refresh_thread = threading.Thread(target=self._refresh,
+                                    args=(departure_tables, effective_date))
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+            return self._refresh_thread
+
+    # --------------------------------
+    def refresh_error(self):
+        """ Returns error message of last failed refresh, or None """
+        return self._refresh_error
+
+    # --------------------------------
+    def _refresh(self, departure_tables, effective_date):
+        """ Refresh thread body. On failure current data stays in use """
+        try:
+            snapshot = self._build_snapshot(True, departure_tables,
+                                            effective_date)
+            self._check_memory(snapshot)
+        except Usage as err:
+            self._refresh_error = err.msg
+            return
+        except Exception as e:
+            self._refresh_error = "Exception refreshing: %s" % e
+            return
+        self._publish(snapshot)
+
+    # --------------------------------
+    def _check_memory(self, snapshot):
+        """ Warns if snapshot data exceeds memory budget, raises Usage if it
+        exceeds memory limit. Sizing is skipped if neither is set """
+        if self._memory_budget is None and self._memory_limit is None:
+            return
+        used = MemoryReport(snapshot).total() / (1024.0 * 1024.0)
+        if self._memory_limit is not None and used > self._memory_limit:
+            raise Usage("Timetable data uses %.1f MB, over %g MB limit" %
+                        (used, self._memory_limit))
+        if self._memory_budget is not None and used > self._memory_budget:
+            print >>sys.stderr, "Warning: timetable data uses %.1f MB, " \
+                    "over %g MB budget" % (used, self._memory_budget)
+
+    # --------------------------------
+    def memory_report(self):
+        """ Returns memory report of current planner data """
+        return MemoryReport(self._snapshot)
+
+    # --------------------------------
+    def _publish(self, snapshot):
+        """ Swaps in snapshot. Class station and geocode caches are replaced
+        by the snapshot's, never mutated. The old snapshot is released once
+        queries using it complete """
+        Station.set_cache(snapshot.stations())
+        Location.set_cache(snapshot.geocodes())
+        self._snapshot = snapshot
+
+    # --------------------------------
+    def _build_snapshot(self, rebuild_cache, departure_tables, effective_date):
+        """ Returns new snapshot loaded from cache files, or rebuilt from
+        the caltrain web page. Only one process rebuilds at a time, others
+        use the cached data meanwhile, or wait for the rebuild if there is
+        none. Doesn't change the current snapshot, nor the class station
+        and geocode caches """
+        # Load schedules cache file. Read it even when rebuilding, so that
+        # rebuilt schedules can be diffed against cached ones
+        cache_objects = Cache.get_file_objects(self._cache_file_path)
+        lock = None
+        if rebuild_cache or not cache_objects:
+            lock = CacheLock(self._cache_file_path, blocking=False)
+            if not lock.acquired():
+                if not cache_objects:
+                    # Nothing to use meanwhile, wait for the other rebuild
+                    debug("Waiting for cache rebuild by another process")
+                    lock = CacheLock(self._cache_file_path)
+                    cache_objects = Cache.get_file_objects(self._cache_file_path)
+                # Use the other rebuild's data, or stale data while it runs.
+                # If there's still none, rebuild holding the lock
+                rebuild_cache = False
+            elif not rebuild_cache:
+                # A rebuild may have completed since the first read
+                cache_objects = Cache.get_file_objects(self._cache_file_path)
+        try:
+            return self._make_snapshot(cache_objects, rebuild_cache,
+                                       departure_tables, effective_date,
+                                       lock is not None and lock.acquired())
+        finally:
+            if lock:
+                lock.release()
+
+    # --------------------------------
+    def _make_snapshot(self, cache_objects, rebuild_cache, departure_tables,
+                       effective_date, locked=False):
+        """ Returns new snapshot from cached schedules, rebuilt from the
+        caltrain web page if none or if asked to. Locked is true if the
+        cache lock is held """
+        previous = self._snapshot
+        changes = []
+        stations = {}
+        geocodes = dict(Location.cache())
+        registry = TimetableRegistry(self._cache_file_path)
+        registry.load_index()
+
+        # Reuse cached station objects, so known stations keep geocodes
+        for schedule in cache_objects:
+            schedule.remember_stations(stations)
+        if cache_objects and not rebuild_cache:
+            # Cached query results are only valid for their schedules
+            query_cache = QueryCache(self._query_cache_size)
             # Read all four schedules from cache
-            (self._weekday_northbound,
-            self._weekday_southbound,
-            self._weekend_northbound,
-            self._weekend_southbound) = cache_objects
+            timetable = registry.set_current(cache_objects)
         else:
+            old_schedules = cache_objects or (None, None, None, None)
+            version = None
+            if cache_objects:
+                version = registry.set_current(cache_objects).version()
+            # Keep query results if current data is what was cached
+            if previous and cache_objects and all(ScheduleDiff(s, c).is_empty()
+                    for s, c in zip(previous.timetable().schedules(), cache_objects)):
+                query_cache = previous.query_cache().copy()
+            else:
+                query_cache = QueryCache(self._query_cache_size)
+
             # No cache or couldn't read. Fetch from web page
-            parser = ScheduleParser()
-            self._weekday_northbound = parser.make_schedule(True, True)
-            self._weekday_southbound = parser.make_schedule(True, False)
-            self._weekend_northbound = parser.make_schedule(False, True)
-            self._weekend_southbound = parser.make_schedule(False, False)
-
-            # Special case remove SJ bus arrivals from weekend table
-            # as they are duplicates of SJ station. Keep lowercase.
-            # Nasty hack, Caltrain didn't even use the same abbreviation
-            # for north and south schedules. WTF.
-            self._weekend_northbound.delete_station("s.j.")
-            self._weekend_southbound.delete_station("sj")
-            # Also remove from Station cache
-            Station.forget("s.j")
-            Station.forget("sj")
-
-            # Force geocoding of all stations in all schedules since
+            new_schedules = self.fetch_schedules(stations)
+
+            # Keep unchanged schedules whole, with their derived data.
+            # Changed ones only drop or rebuild data of affected stations
+            schedules = []
+            for old, new in zip(old_schedules, new_schedules):
+                diff = ScheduleDiff(old, new)
+                changes.append(diff)
+                if diff.is_empty():
+                    schedules.append(old)
+                    continue
+                if departure_tables or (old and old.has_departure_tables()):
+                    new.build_departure_tables(reuse_from=old)
+                new.render()
+                schedules.append(new)
+
+            changed = any(not diff.is_empty() for diff in changes)
+            if changed:
+                # Timetable changed, it becomes a new version. Query results
+                # of an in place correction must drop affected stations,
+                # those of any other version it replaces are all dropped
+                effective_from = effective_date or date.today()
+                replaced = effective_from in [v[0] for v in registry.versions()]
+                timetable = registry.add_version(schedules, effective_from)
+                if cache_objects and timetable.version() == version and \
+                        list(timetable.schedules()) == schedules:
+                    for diff, old in zip(changes, old_schedules):
+                        if not diff.is_empty():
+                            query_cache.invalidate(version, old.name(),
+                                                   diff.affected_stations())
+                elif replaced:
+                    query_cache.invalidate(effective_from)
+            else:
+                timetable = registry.current()
+
+            # Also remove stations no longer scheduled from Station cache
+            listed = timetable.list_stations()
+            for st_name in Station.cached_names(stations):
+                if st_name not in listed:
+                    Station.forget(st_name, stations)
+
+            # Force geocoding of new stations in all schedules since
             # they will be used often. This updates location cache.
-            Station.geocode_all()
+            Station.geocode_all(stations, geocodes)
 
             # Force save location cache
-            Location.save_cache()
+            Location.save_cache(geocodes)
 
-            # Save schedules cache file
-            cache_objects = (self._weekday_northbound,
-                        self._weekday_southbound,
-                        self._weekend_northbound,
-                        self._weekend_southbound)
+            # Save schedules cache file, then the version index naming it
+            cache_objects = timetable.schedules()
             Cache.put_file_objects(self._cache_file_path, cache_objects)
+            if changed:
+                registry.save_index()
+
+        # Cached schedules may predate derived data. Build and re-save
+        if timetable.build_derived_data(departure_tables):
+            self._save_derived_data(cache_objects, locked)
+
+        return PlannerSnapshot(registry, timetable, query_cache, stations,
+                               geocodes, changes)
 
     # --------------------------------
-    def list_stations(self):
-        """ Return sorted list of all stations from all schedules.
+    def _save_derived_data(self, schedules, locked):
+        """ Re-saves cached schedules with derived data. Unless the cache
+        lock is already held, takes it first, and skips saving if another
+        process holds it or has replaced the cache since it was read """
+        if locked:
+            Cache.put_file_objects(self._cache_file_path, schedules)
+            return
+        with CacheLock(self._cache_file_path, blocking=False) as lock:
+            if not lock.acquired():
+                return
+            cached = Cache.get_file_objects(self._cache_file_path)
+            if len(cached) == len(schedules) and all(ScheduleDiff(c, s).is_empty()
+                    for c, s in zip(cached, schedules)):
+                Cache.put_file_objects(self._cache_file_path, schedules)
+
+    # --------------------------------
+    def fetch_schedules(self, stations):
+        """ Returns weekday nb, weekday sb, weekend nb, weekend sb schedules
+        parsed from the caltrain web page, adding their stations to given
+        dict """
+        parser = ScheduleParser(stations)
+        schedules = (parser.make_schedule(True, True),
+                     parser.make_schedule(True, False),
+                     parser.make_schedule(False, True),
+                     parser.make_schedule(False, False))
+
+        # Special case remove SJ bus arrivals from weekend table
+        # as they are duplicates of SJ station. Keep lowercase.
+        # Nasty hack, Caltrain didn't even use the same abbreviation
+        # for north and south schedules. WTF.
+        schedules[2].delete_station("s.j.")
+        schedules[3].delete_station("sj")
+        return schedules
+
+    # --------------------------------
+    def changes(self):
+        """ Returns schedule diffs of last rebuild, empty if loaded from cache """
+        return self._snapshot.changes()
+
+    # --------------------------------
+    def print_changes(self, output_JSON=False):
+        """ Prints change report of last rebuild to stderr """
+        if output_JSON:
+            print >>sys.stderr, json.dumps([d.to_dict() for d in self.changes()],
+                                           indent=2)
+        else:
+            for diff in self.changes():
+                print >>sys.stderr, diff
+
+    # --------------------------------
+    def timetable_versions(self):
+        """ Returns list of (effective from, effective to, file path) """
+        return self._snapshot.registry().versions()
+
+    # --------------------------------
+    def departure_tables_size(self):
+        """ Returns bytes used by departure tables of current timetable """
+        return self._snapshot.timetable().departure_tables_size()
+
+    # --------------------------------
+    def list_stations(self, on_date=None):
+        """ Return sorted list of all stations from all schedules of the
+        timetable effective on given date (current otherwise).
         Could be improved by returning Station class cache, but that
         needs to be fixed to remove stations that were deleted. So
         using this set combining instead. """
-        all = self._weekday_northbound.list_stations() + \
-                self._weekday_southbound.list_stations() + \
-                self._weekend_northbound.list_stations() + \
-                self._weekend_southbound.list_stations()
-        return sorted(list(set(all)))
+        return self._snapshot.timetable_on(on_date).list_stations()
 
     # --------------------------------
     def get_earliest(self, when, start_location, destination_name):
         """ Returns origin name and dep time for earliest route """
-        origin_name, schedule = self._select_departure(when,
-                                    start_location, destination_name)
-        dep_time = None
-        if schedule:
-            dep_time = schedule.get_earliest(when, origin_name,
-                                             destination_name)
-        return origin_name, dep_time
+        return self._get_service_route(when, start_location, destination_name,
+                        "earliest", lambda schedule, minute, origin_name:
+                            schedule.get_earliest(minute, origin_name,
+                                                  destination_name))
 
     # --------------------------------
     def get_fastest(self, when, start_location, destination_name, all):
@@ -717,42 +2079,267 @@ class RoutePlanner(object):
                 OR if all
             2. dict of durations and their dep times.
         """
-        origin_name, schedule = self._select_departure(when,
-                                    start_location, destination_name)
-        dep_times = None
-        if schedule:
-            dep_times = schedule.get_fastest(when, origin_name,
-                                               destination_name, all)
-        return origin_name, dep_times
+        return self._get_service_route(when, start_location, destination_name,
+                        "fastest_all" if all else "fastest",
+                        lambda schedule, minute, origin_name:
+                            schedule.get_fastest(minute, origin_name,
+                                                 destination_name, all))
 
     # --------------------------------
-    def print_stations(self):
-        print ', '.join(self.list_stations())
+    def get_arrive_by(self, when, start_location, destination_name):
+        """ Returns nearest origin name and departure, arrival times of
+        latest route arriving at destination by given time """
+        # Results change at arrivals, not the query cache's departures
+        return self._get_service_route(when, start_location, destination_name,
+                        None, lambda schedule, minute, origin_name:
+                            schedule.get_arrive_by(minute, origin_name,
+                                                   destination_name))
 
     # --------------------------------
-    def print_schedules(self, single_station_name=None):
-        """ Prints single or all schedules to console """
-        self._weekday_northbound.print_details(single_station_name)
-        self._weekday_southbound.print_details(single_station_name)
-        self._weekend_northbound.print_details(single_station_name)
-        self._weekend_southbound.print_details(single_station_name)
+    def _get_service_route(self, when, start_location, destination_name,
+                           query, compute):
+        """ Returns nearest origin name and result of compute(schedule,
+        minute, origin name) for each service day of given time, see
+        _service_minutes, until one has a result. Results are kept in the
+        query cache under query kind, unless it's None """
+        snapshot = self._snapshot
+        for service_date, minute in RoutePlanner._service_minutes(when):
+            origin_name, schedule = self._select_departure(service_date,
+                                    start_location, destination_name, snapshot)
+            result = None
+            if schedule and query:
+                version = snapshot.timetable_on(service_date).version()
+                result = snapshot.query_cache().get(version, schedule, minute,
+                                origin_name, destination_name, query,
+                                lambda: compute(schedule, minute, origin_name))
+            elif schedule:
+                result = compute(schedule, minute, origin_name)
+            if result:
+                break
+        return origin_name, result
 
     # --------------------------------
-    def is_valid_station_name(self, station_name):
-        """ Returns true if given station name exists in any schedule """
-        all_names = self.list_stations()
-        return station_name in all_names
+    def get_route(self, query, when, start_location, destination_name):
+        """ Returns nearest origin name and result of given query kind:
+        earliest, fastest, all (fastest routes) or arrive_by """
+        if query == 'earliest':
+            return self.get_earliest(when, start_location, destination_name)
+        elif query in ('fastest', 'all'):
+            return self.get_fastest(when, start_location, destination_name,
+                                    query == 'all')
+        elif query == 'arrive_by':
+            return self.get_arrive_by(when, start_location, destination_name)
+        raise Usage("Unknown query type, use earliest, fastest, all or arrive_by")
 
     # --------------------------------
-    def _select_departure(self, when, start_location, destination_name):
-        """ Returns station name and schedule for given route and day
-        or none if unable to connect """
-        if when.weekday() >= 5:
-            nb = self._weekend_northbound   # Sat - Sun
-            sb = self._weekend_southbound
+    def sweep(self, start_date, end_date, start_time, start_location,
+              destination_name, query='earliest', end_time=None,
+              step_minutes=SWEEP_STEP_MINUTES):
+        """ Generates (date, time, origin name, result) of query (as for
+        get_route) for every date from start to end date, at start time,
+        or every step minutes from start to end time if given. Results
+        only depend on the service days' schedules, so each is computed
+        once per timetable versions and weekday or weekend schedules, then
+        reused for other dates. Generated in date order. Raises Usage if
+        the end date or time is before the start """
+        if end_date < start_date:
+            raise Usage("Sweep end date is before start date")
+        # Midnight is a false time, compare with None
+        if end_time is not None and end_time < start_time:
+            raise Usage("Window end time is before start time")
+        times = [start_time]
+        if end_time is not None:
+            when = datetime.combine(start_date, start_time)
+            while True:
+                when += timedelta(minutes=step_minutes)
+                if when.date() != start_date or when.time() > end_time:
+                    break
+                times.append(when.time())
+        results = {}
+        day = start_date
+        while day <= end_date:
+            for tm in times:
+                when = datetime.combine(day, tm)
+                key = self._service_day_key(when) + (tm,)
+                if key not in results:
+                    results[key] = self.get_route(query, when, start_location,
+                                                  destination_name)
+                origin_name, result = results[key]
+                yield day, tm, origin_name, result
+            day += timedelta(days=1)
+
+    # --------------------------------
+    def _service_day_key(self, when):
+        """ Returns (timetable version, weekend) of schedules of each
+        service day a query at given time uses, see _service_minutes """
+        key = ()
+        for day, minute in RoutePlanner._service_minutes(when):
+            key += (self._snapshot.timetable_on(day).version(),
+                    day.weekday() >= 5)
+        return key
+
+    # --------------------------------
+    def query_cache_stats(self):
+        """ Returns query result cache counters """
+        return self._snapshot.query_cache().stats()
+
+    # --------------------------------
+    def next_departure(self, when, station_name, northbound=True):
+        """ Returns departure time of next train leaving named station in
+        given direction at or after given time, or None """
+        snapshot = self._snapshot
+        for service_date, minute in RoutePlanner._service_minutes(when):
+            nb, sb = self._day_schedules(service_date, snapshot)
+            schedule = nb if northbound else sb
+            col = schedule.next_departure(minute, station_name)
+            if col is not None:
+                return schedule.station_time(station_name, col)
+        return None
+
+    # --------------------------------
+    def departure_board(self, station_name, count=5, when=None):
+        """ Returns departure board cursor for named station. It's a
+        generator yielding the next count departures in each direction,
+        as a list of dicts sorted by departure, for the time sent to it
+        (given time on first next(), now when None is sent). As time moves
+        forward the cursor advances past departed trains instead of
+        scanning the schedule again, or with departure tables built, looks
+        up the next departure in them. Early morning times list the previous
+        day's trains still running, then the same date's, see
+        _service_minutes """
+        station_name = station_name.lower().strip()
+        service = None
+        while True:
+            if when is None:
+                when = datetime.now()
+            service_date, minute = RoutePlanner._service_minute(when)
+            next_date = service_date + timedelta(days=1)
+            timetables = (self._snapshot.timetable_on(service_date),
+                          self._snapshot.timetable_on(next_date))
+            if service != (timetables, service_date):
+                # New service day or data, restart cursors on its schedules,
+                # followed by the next date's past 24h
+                service = (timetables, service_date)
+                cursors = []
+                for direction, schedule, next_schedule in zip(
+                        ("northbound", "southbound"),
+                        timetables[0].day_schedules(service_date),
+                        timetables[1].day_schedules(next_date)):
+                    # Rows are formatted here once, ticks only slice them
+                    departures = schedule.departures(station_name)
+                    service_end = len(departures)
+                    departures += [(dep[0] + 24 * 60,) + dep[1:] for dep
+                                   in next_schedule.departures(station_name)]
+                    minutes = [d[0] for d in departures]
+                    positions = dict((departures[pos][1], pos)
+                                     for pos in xrange(service_end))
+                    cursors.append([direction, schedule, departures, minutes,
+                                    positions, service_end,
+                                    bisect_left(minutes, minute), minute])
+            rows = []
+            for cursor in cursors:
+                (direction, schedule, departures, minutes, positions,
+                 service_end, pos, last) = cursor
+                if schedule.has_departure_tables():
+                    # Table entry is the service day's next departure. None
+                    # once they're all gone, the next date's follow
+                    col = schedule.next_departure(minute, station_name)
+                    pos = positions.get(col, service_end)
+                else:
+                    if minute < last:
+                        # Clock went back, reposition
+                        pos = bisect_left(minutes, minute)
+                    while pos < len(minutes) and minutes[pos] < minute:
+                        pos += 1
+                cursor[6:] = [pos, minute]
+                # Next date's trains only once past midnight
+                end = len(departures) if minute >= 24 * 60 else service_end
+                for dep_minute, col, departure, terminal, arrival in \
+                        departures[pos:min(pos + count, end)]:
+                    rows.append(OrderedDict((
+                        ('direction', direction),
+                        ('departure', departure),
+                        ('destination', terminal),
+                        ('arrival', arrival),
+                        ('minutes', dep_minute - minute))))
+            rows.sort(key=lambda row: row['minutes'])
+            when = yield rows
+
+    # --------------------------------
+    def print_departure_board(self, station_name, when, output_JSON=False):
+        """ Prints upcoming departures of named station at given time """
+        rows = next(self.departure_board(station_name, when=when))
+        if output_JSON:
+            print json.dumps(rows, indent=2)
         else:
-            nb = self._weekday_northbound   # Mon - Fri
-            sb = self._weekday_southbound
+            for row in rows:
+                print "%(departure)s  %(direction)-10s  to %(destination)s " \
+                      "(arrives %(arrival)s)" % row
+
+    # --------------------------------
+    @staticmethod
+    def _service_minute(when):
+        """ Returns service day date and minutes since its start for given
+        datetime. Early morning times count past 24h of the day before """
+        service_date = when.date()
+        minute = when.hour * 60 + when.minute
+        if when.hour < RoutePlanner.SERVICE_DAY_START_HOUR:
+            service_date -= timedelta(days=1)
+            minute += 24 * 60
+        return service_date, minute
+
+    # --------------------------------
+    @staticmethod
+    def _service_minutes(when):
+        """ Returns list of (service day date, minutes since its start) to
+        query for given datetime, in order until one has routes. Early
+        morning times first look for the previous day's trains still
+        running, then fall back to the same date's service, whose trains
+        all depart later """
+        service_minutes = [RoutePlanner._service_minute(when)]
+        if when.hour < RoutePlanner.SERVICE_DAY_START_HOUR:
+            service_minutes.append((when.date(), when.hour * 60 + when.minute))
+        return service_minutes
+
+    # --------------------------------
+    def print_stations(self, on_date=None):
+        print ', '.join(self.list_stations(on_date))
+
+    # --------------------------------
+    def print_schedules(self, single_station_name=None, output_JSON=False,
+                        on_date=None):
+        """ Prints single or all schedules of timetable effective on given
+        date (current otherwise) to console, from pre-rendered output in a
+        single write """
+        schedules = self._snapshot.timetable_on(on_date).schedules()
+        if output_JSON:
+            sys.stdout.write('[\n%s\n]\n' % ', \n'.join(
+                    s.rendered_json(single_station_name) for s in schedules))
+        else:
+            sys.stdout.write(''.join(
+                    s.rendered_text(single_station_name) for s in schedules))
+
+    # --------------------------------
+    def is_valid_station_name(self, station_name, on_date=None):
+        """ Returns true if given station name exists in any schedule of
+        timetable effective on given date (current otherwise) """
+        all_names = self.list_stations(on_date)
+        return station_name in all_names
+
+    # --------------------------------
+    def _day_schedules(self, service_date, snapshot=None):
+        """ Returns northbound and southbound schedules of given service
+        day, from given snapshot (current otherwise) """
+        snapshot = snapshot or self._snapshot
+        return snapshot.timetable_on(service_date).day_schedules(service_date)
+
+    # --------------------------------
+    def _select_departure(self, service_date, start_location, destination_name,
+                          snapshot=None):
+        """ Returns station name and schedule for given route and service
+        day or none if unable to connect. Uses given snapshot (current
+        otherwise), so a query sees a single snapshot """
+        nb, sb = self._day_schedules(service_date, snapshot)
         # Find nearest station to start location.
         # It's same for north or south bound, so use north
         origin_station = nb.find_nearest_station(start_location)
@@ -783,17 +2370,33 @@ class Usage(Exception):
         else:
             self.msg = """
 
-Usage: caltrain [-fansjz] [-d date] [-t time] [-c coords] [-g address] destination
+Usage: caltrain [-fansjzbr] [-d date] [-t time] [-D date] [-w time] [-c coords] [-g address] destination
+       caltrain [-z] -i file
+       caltrain [-z] --mem-report
     -d  Route from given date (uses current otherwise)
-    -t  Route from given time (uses current otherwise)
+    -t  Route from given time (uses current otherwise). Times before 3:00
+        are the end of the previous date's service, in all modes, then the
+        same date's once none of its trains are left
+    -D  Route every date from -d date to given end date
+    -w  Route every 15 minutes from -t time to given time
     -c  Route from coordinates lat,lon (with comma)
     -g  Route from geocoded text (address, city, etc)
     -f  Return fastest route and duration
     -a  Return all routes (only for fastest)
+    -r  Return latest route arriving by date and time instead
+    -b  Display next departures from station, both directions
     -n  Display all valid station names
     -s  Display all schedules (stations and times)
     -j  Display output in JSON (only works on some options)
     -z  Rebuild cache files
+    -e  Date rebuilt timetable takes effect, if changed (today otherwise)
+    -i  Answer newline-delimited JSON queries from file (- for stdin)
+    --mem-report  Display memory used by loaded timetable data, in JSON.
+                  Traced totals need the pytracemalloc package (null without)
+    --mem-budget  Warn if loaded timetable data uses more than given MB
+    --mem-limit   Fail if loaded timetable data uses more than given MB
+    --departure-tables  Build next departure lookup tables, kept in cache
+                        and used by -b
 
     destination - station name (use -n for valid names list)
 
@@ -809,10 +2412,18 @@ Examples:
     Display Millbrae schedule:
         caltrain.py 'Millbrae'
 
+    Display next Millbrae departures in both directions:
+        caltrain.py -b 'Millbrae'
+
     Display next departure from station nearest to coordinates stopping in San Mateo.
 
         caltrain.py -c 37.4484914,-122.1802812 'San Mateo'
 
+    Display latest departure from station nearest to coordinates arriving in
+    San Francisco by 9:00, in JSON format.
+
+        caltrain.py -rj -t 9:00 -c 37.4484914,-122.1802812 'San Francisco'
+
     Display all next fastest-ordered routes to Sunnyvale from station nearest to
     SFO Starbucks, in JSON format.
 
@@ -837,7 +2448,135 @@ Examples:
 
         caltrain.py -d 4-29-2014 -t 17:15 -g 'Le Boulanger, Sunnyvale, CA', 'Palo Alto'
 
+    Display earliest departures to Palo Alto for a week of commutes, every
+    15 minutes from 7:30 to 8:30, one JSON result per line.
+
+        caltrain.py -j -d 4-28-2014 -D 5-4-2014 -t 7:30 -w 8:30 -c 37.4484914,-122.1802812 'Palo Alto'
+
+    Answer a batch of queries, one JSON object per line, writing one JSON
+    result per line. Fields: destination, coords or address, optional date,
+    time and query (earliest, fastest, all or arrive_by).
+
+        echo '{"destination": "palo alto", "coords": "37.44,-122.18"}' | caltrain.py -i -
+
 """
+# -------------------------------------------------------------------------------
+# Query helpers
+#
+# Parsing and validation of query arguments shared by command-line and batch
+# modes. All raise Usage with a message on bad input.
+# -------------------------------------------------------------------------------
+def parse_date(text):
+    """ Returns date from mm-dd-yyyy text """
+    try:
+        return datetime.strptime(text, '%m-%d-%Y').date()
+    except ValueError:
+        raise Usage("Use date format mm-dd-yyyy")
+
+def parse_time(text):
+    """ Returns time from 24-hour HH:MM text """
+    try:
+        return datetime.strptime(text, '%H:%M').time()
+    except ValueError:
+        raise Usage("Use 24-hour time format HH:MM")
+
+def make_location(coordinates=None, address=None):
+    """ Returns location from lat,lon coordinates text or address,
+    or None if neither given """
+    if coordinates:
+        try:
+            # Check coords integrity
+            coordinates = coordinates.split(',')
+            lat=float(coordinates[0])
+            lon=float(coordinates[1])
+            return Location(lat=lat, lon=lon, dont_cache=True)
+        except (ValueError, IndexError):
+            raise Usage("Invalid coordinates. Check format.")
+    elif address:
+        return Location(address=address, dont_cache=True)
+    return None
+
+def parse_megabytes(text):
+    """ Returns megabytes from number text """
+    try:
+        return float(text)
+    except ValueError:
+        raise Usage("Use a number of MB for memory budget and limit")
+
+def load_planner(rp, rebuild_cache, output_JSON=False, effective_date=None,
+                 departure_tables=False):
+    """ Loads route planner, reporting schedule changes if rebuilt """
+    rp.load(rebuild_cache, departure_tables, effective_date)
+    if rebuild_cache:
+        rp.print_changes(output_JSON)
+
+def check_destination(rp, destination, on_date=None):
+    """ Returns normalized destination station name if valid in timetable
+    effective on given date (current otherwise) """
+    destination = str(destination).lower().strip()
+    if not rp.is_valid_station_name(destination, on_date):
+        raise Usage("Unknown station name. Use -n to display list.")
+    return destination
+
+# -------------------------------------------------------------------------------
+# Batch queries
+#
+# Answers newline-delimited JSON queries with a single loaded route planner,
+# writing one JSON result per line. Errors are reported per line so that one
+# bad query doesn't stop the batch. Output is flushed after every line so
+# results stream through long-running pipelines.
+# -------------------------------------------------------------------------------
+def run_batch(rp, in_stream, out_stream):
+    """ Answers each query line in input stream, writes results """
+    line_num = 0
+    # Avoid file iterator read-ahead, which would hold back piped queries
+    for line in iter(in_stream.readline, ''):
+        line_num += 1
+        if not line.strip():
+            continue
+        reply = {'line' : line_num}
+        try:
+            try:
+                query = json.loads(line)
+            except ValueError:
+                raise Usage("Invalid JSON query")
+            if not isinstance(query, dict):
+                raise Usage("Query must be a JSON object")
+            if 'id' in query:
+                reply['id'] = query['id']
+            reply.update(answer_query(rp, query))
+        except Usage as err:
+            reply['error'] = err.msg
+        except Exception as e:
+            reply['error'] = "Exception answering query: %s" % e
+        out_stream.write(json.dumps(reply) + '\n')
+        out_stream.flush()
+
+def answer_query(rp, query):
+    """ Returns result dict for a batch query dict """
+    if 'destination' not in query:
+        raise Usage("Query needs a destination")
+    now = datetime.now()
+    dep_date = parse_date(query['date']) if query.get('date') else now.date()
+    dep_time = parse_time(query['time']) if query.get('time') else now.time()
+    when = datetime.combine(dep_date, dep_time)
+    # Routed on the service day's timetable, see -t
+    destination = check_destination(rp, query['destination'],
+                                    RoutePlanner._service_minute(when)[0])
+    coordinates = query.get('coords')
+    if isinstance(coordinates, (list, tuple)):
+        coordinates = ','.join(map(str, coordinates))
+    location = make_location(coordinates, query.get('address'))
+    if not location:
+        raise Usage("Query needs coords or address")
+    origin_station, result = rp.get_route(query.get('query', 'earliest'),
+                                          when, location, destination)
+    if not result:
+        if origin_station:
+            raise Usage("No routes from nearest station: " + origin_station)
+        raise Usage("Could not determine nearest station")
+    return {'origin' : origin_station, 'result' : result}
+
 # -------------------------------------------------------------------------------
 # main
 #
@@ -850,6 +2589,7 @@ def main(argv=None):
     try:
         # Init operation defaults
         earliest = True
+        arrive_by = False
         now = datetime.now()
         dep_date = now.date()
         dep_time = now.time()
@@ -857,14 +2597,25 @@ def main(argv=None):
         output_JSON = False
         display_station_names = False
         display_schedules = False
+        display_board = False
         coordinates = None
         address = None
         location = None
         rebuild_cache = False
+        effective_date = None
+        batch_path = None
+        sweep_end_date = None
+        window_end_time = None
+        memory_report = False
+        memory_budget = None
+        memory_limit = None
+        departure_tables = False
 
         try:
             # Extract options and non-option arguments
-            opts, args = getopt.getopt(argv[1:], "fansjzd:t:c:g:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "fansjzbrd:t:c:g:i:e:D:w:",
+                        ["help", "mem-report", "mem-budget=", "mem-limit=",
+                         "departure-tables"])
         except getopt.error, msg:
             raise Usage(msg)
 
@@ -880,70 +2631,123 @@ def main(argv=None):
                 address = a.strip()
             elif o in ("-a"):
                 all_routes = True
+            elif o == "-r":
+                arrive_by = True
             elif o in ("-n"):
                 display_station_names = True
             elif o in ("-s"):
                 display_schedules = True
+            elif o == "-b":
+                display_board = True
             elif o in ("-j"):
                 output_JSON = True
             elif o in ("-z"):
                 rebuild_cache = True
+            elif o == "-i":
+                batch_path = a
+            elif o == "-e":
+                effective_date = parse_date(a)
             elif o == "-d":
-                try:
-                    dep_date = datetime.strptime(a, '%m-%d-%Y').date()
-                except ValueError:
-                    raise Usage("Use date format mm-dd-yyyy")
+                dep_date = parse_date(a)
             elif o == "-t":
-                try:
-                    dep_time = datetime.strptime(a, '%H:%M').time()
-                except ValueError:
-                    raise Usage("Use 24-hour time format HH:MM")
+                dep_time = parse_time(a)
+            elif o == "-D":
+                sweep_end_date = parse_date(a)
+            elif o == "-w":
+                window_end_time = parse_time(a)
+            elif o == "--mem-report":
+                memory_report = True
+            elif o == "--mem-budget":
+                memory_budget = parse_megabytes(a)
+            elif o == "--mem-limit":
+                memory_limit = parse_megabytes(a)
+            elif o == "--departure-tables":
+                departure_tables = True
             else:
                 assert False, "Unknown option"
 
         # Init planner to do all work
-        rp = RoutePlanner()
-
-        if display_station_names:
-            rp.load(rebuild_cache)
-            rp.print_stations()
+        rp = RoutePlanner(memory_budget=memory_budget,
+                          memory_limit=memory_limit)
+
+        if memory_report:
+            if tracemalloc:
+                tracemalloc.start()
+            load_planner(rp, rebuild_cache, output_JSON, effective_date,
+                         departure_tables)
+            print json.dumps(rp.memory_report().to_dict(), indent=2)
+        elif display_station_names:
+            load_planner(rp, rebuild_cache, output_JSON, effective_date,
+                         departure_tables)
+            rp.print_stations(dep_date)
         elif display_schedules:
-            rp.load(rebuild_cache)
-            rp.print_schedules()
+            load_planner(rp, rebuild_cache, output_JSON, effective_date,
+                         departure_tables)
+            rp.print_schedules(output_JSON=output_JSON, on_date=dep_date)
+        elif batch_path:
+            load_planner(rp, rebuild_cache, output_JSON, effective_date,
+                         departure_tables)
+            if batch_path == '-':
+                run_batch(rp, sys.stdin, sys.stdout)
+            else:
+                try:
+                    with open(batch_path) as f:
+                        run_batch(rp, f, sys.stdout)
+                except IOError as e:
+                    raise Usage("Can't read queries: %s" % e)
         else:
             # Should have only destination station name argument
             if len(args) != 1:
                 raise Usage()
 
-            rp.load(rebuild_cache)
+            load_planner(rp, rebuild_cache, output_JSON, effective_date,
+                         departure_tables)
 
             # Create location from coordinates if given. Otherwise create
             # from address if that was given
-            if coordinates:
-                try:
-                    # Check coords integrity
-                    coordinates = coordinates.split(',')
-                    lat=float(coordinates[0])
-                    lon=float(coordinates[1])
-                    location = Location(lat=lat, lon=lon, dont_cache=True)
-                except ValueError:
-                    raise Usage("Invalid coordinates. Check format.")
-            elif address:
-                location = Location(address=address, dont_cache=True)
-
-            # Init and check destination station name
-            destination = str(args[0]).lower().strip()
-            if not rp.is_valid_station_name(destination):
-                raise Usage("Unknown station name. Use -n to display list.")
+            location = make_location(coordinates, address)
+
+            # Init and check destination station name, in the timetable of
+            # the service day when routing, see -t
+            when = datetime.combine(dep_date, dep_time)
+            on_date = dep_date
+            if location or display_board:
+                on_date = RoutePlanner._service_minute(when)[0]
+            destination = check_destination(rp, args[0], on_date)
+
+            sweeping = sweep_end_date or window_end_time is not None
+            if sweeping and not location:
+                raise Usage("Use -c or -g to route every date or time")
+
+            # Query kind from options
+            if arrive_by:
+                query = 'arrive_by'
+            elif earliest:
+                query = 'earliest'
+            else:
+                query = 'all' if all_routes else 'fastest'
 
             # If location found, try routing to destination
-            if location:
-                # Make current date/time
-                when = datetime.combine(dep_date, dep_time)
-                if earliest:
-                    origin_station, result = rp.get_earliest(when, location, destination)
-                else:
-                    origin_station, result = rp.get_fastest(when, location, destination, all_routes)
+            if display_board:
+                rp.print_departure_board(destination, when, output_JSON)
+            elif sweeping:
+                # Route every date and time, streaming results
+                for day, tm, origin_station, result in rp.sweep(dep_date,
+                        sweep_end_date or dep_date, dep_time, location,
+                        destination, query, window_end_time):
+                    if output_JSON:
+                        print json.dumps(OrderedDict((
+                                ('date', day.strftime('%m-%d-%Y')),
+                                ('time', tm.strftime('%H:%M')),
+                                ('origin', origin_station),
+                                ('result', result))))
+                    else:
+                        print day.strftime('%m-%d-%Y'), tm.strftime('%H:%M'), \
+                              (origin_station, result)
+                    sys.stdout.flush()
+            elif location:
+                origin_station, result = rp.get_route(query, when, location,
+                                                      destination)
 
                 # Output results in JSON or plain
                 if result:
@@ -958,7 +2762,7 @@ def main(argv=None):
                         raise Usage("Could not determine nearest station")
             else:
                 # No location. Give info on destination station
-                rp.print_schedules(destination)
+                rp.print_schedules(destination, output_JSON, dep_date)
 
     except Usage, err:
         print >>sys.stderr, err.msg
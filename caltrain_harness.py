@@ -0,0 +1,507 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------------------
+# caltrain_harness.py
+#
+# Differential equivalence harness for caltrain.py query paths. Generates
+# random timetables and queries, answers them with the reference planner and
+# with alternative engines side by side, and reports any differing result with
+# a minimized reproducer, along with per-engine timing.
+# Timetables go through the same time parsing as the Caltrain page, so their
+# 12 and 24 hour rollovers behave as real ones do.
+# -------------------------------------------------------------------------------
+
+import json
+import sys
+import getopt
+import random
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from caltrain import (RoutePlanner, Schedule, ScheduleParser, Station,
+                      Timetable, Usage, answer_query, check_destination,
+                      make_location, parse_date, parse_time)
+
+# Schedule names, in timetable order
+SCHEDULE_NAMES = ("Weekday Northbound Schedule",
+                  "Weekday Southbound Schedule",
+                  "Weekend and Holiday Northbound Schedule",
+                  "Weekend and Holiday Southbound Schedule")
+
+# Query kinds: batch query types plus next departure from a station
+QUERY_KINDS = ('earliest', 'fastest', 'all', 'arrive_by', 'next')
+
+# Monday starting the two weeks queries are spread over
+FIRST_QUERY_DATE = date(2014, 4, 21)
+
+# -------------------------------------------------------------------------------
+# Timetable generation
+#
+# Timetables are kept as JSON friendly specs, so that reproducers can be
+# printed and read back: station names and coordinates, then per schedule its
+# station order and trains, each a list of "h:mm AM|PM" cells (None where the
+# train doesn't stop) like the Caltrain page shows them.
+# -------------------------------------------------------------------------------
+def random_timetable(rng, max_stations=8, max_trains=12, prefix="station"):
+    """ Returns random timetable spec, station names starting with prefix """
+    stations = []
+    for i in xrange(rng.randint(2, max_stations)):
+        stations.append(["%s %d" % (prefix, i + 1),
+                         round(37.0 + 0.05 * i + rng.uniform(-0.01, 0.01), 5),
+                         round(-122.0 + rng.uniform(-0.05, 0.05), 5)])
+    names = [st[0] for st in stations]
+    schedules = []
+    for name in SCHEDULE_NAMES:
+        order = names if "Southbound" in name else list(reversed(names))
+        schedules.append(OrderedDict((('name', name),
+                                      ('stations', order),
+                                      ('trains', random_trains(rng, len(order),
+                                                               max_trains)))))
+    return OrderedDict((('stations', stations), ('schedules', schedules)))
+
+def random_trains(rng, num_stations, max_trains):
+    """ Returns random train columns, sorted by first departure. Trains run
+    from 4am to after midnight, some skip stops and speeds vary so that
+    some overtake others """
+    starts = sorted(rng.randint(4 * 60, 25 * 60 + 30)
+                    for i in xrange(rng.randint(0, max_trains)))
+    trains = []
+    for minute in starts:
+        cells = []
+        for idx in xrange(num_stations):
+            if idx and rng.random() < 0.2:
+                cells.append(None)
+            else:
+                cells.append(cell_text(minute))
+            minute += rng.randint(2, 12)
+        trains.append(cells)
+    return trains
+
+def cell_text(minute):
+    """ Returns timetable cell text for minutes since midnight """
+    hour, minutes = divmod(minute, 60)
+    hour %= 24
+    return "%d:%02d %s" % (hour % 12 or 12, minutes, "PM" if hour >= 12 else "AM")
+
+def build_schedules(spec, stations=None):
+    """ Returns schedules tuple for timetable spec, with new stations,
+    also added to given stations dict """
+    if stations is None:
+        stations = {}
+    for name, lat, lon in spec['stations']:
+        stations[name] = Station(name, lat, lon)
+    schedules = []
+    for sched in spec['schedules']:
+        schedule = Schedule(sched['name'])
+        for idx, name in enumerate(sched['stations']):
+            cells = []
+            for train in sched['trains']:
+                text = train[idx]
+                cells.append((text.split()[0], text.endswith("PM")) if text else None)
+            schedule.add_station_with_times(name,
+                                ScheduleParser.make_times(cells), stations)
+        schedules.append(schedule)
+    return tuple(schedules)
+
+def random_queries(rng, spec, count):
+    """ Returns list of random query dicts for timetable spec, in batch
+    query format. Next departure queries add a direction """
+    queries = []
+    for i in xrange(count):
+        name, lat, lon = rng.choice(spec['stations'])
+        query = OrderedDict((
+            ('query', rng.choice(QUERY_KINDS)),
+            ('date', (FIRST_QUERY_DATE + timedelta(days=rng.randint(0, 13)))
+                        .strftime('%m-%d-%Y')),
+            ('time', "%02d:%02d" % (rng.randint(0, 23), rng.randint(0, 59))),
+            ('coords', "%.5f,%.5f" % (lat + rng.uniform(-0.02, 0.02),
+                                      lon + rng.uniform(-0.02, 0.02))),
+            ('destination', rng.choice(spec['stations'])[0])))
+        if query['query'] == 'next':
+            query['northbound'] = rng.random() < 0.5
+        queries.append(query)
+    return queries
+
+# -------------------------------------------------------------------------------
+# Engines
+#
+# An engine is a function taking a schedules tuple and returning a function
+# that answers query dicts. Answers are dicts, as from caltrain.answer_query.
+# The reference engine doesn't use the planner's query paths: it scans every
+# train of the service days a query searches, spelled out here on its own.
+# -------------------------------------------------------------------------------
+def reference_engine(schedules):
+    """ Returns reference answer function for schedules """
+    rp = RoutePlanner(query_cache_size=0)
+    rp.load_schedules(schedules)
+    timetable = Timetable(schedules)
+    return lambda query: scan_answer(rp, timetable, query)
+
+def planner_engine(schedules):
+    """ Returns answer function of planner without query result cache
+    or departure tables """
+    rp = RoutePlanner(query_cache_size=0)
+    rp.load_schedules(schedules)
+    return lambda query: planner_answer(rp, query)
+
+def query_cache_engine(schedules):
+    """ Returns answer function of planner with query result cache """
+    rp = RoutePlanner()
+    rp.load_schedules(schedules)
+    return lambda query: planner_answer(rp, query)
+
+def departure_tables_engine(schedules):
+    """ Returns answer function of planner with departure tables """
+    rp = RoutePlanner(query_cache_size=0)
+    rp.load_schedules(schedules, departure_tables=True)
+    return lambda query: planner_answer(rp, query)
+
+# Alternative engines checked by default
+ENGINES = OrderedDict((('planner', planner_engine),
+                       ('query_cache', query_cache_engine),
+                       ('departure_tables', departure_tables_engine)))
+
+def query_when(query):
+    """ Returns datetime of query """
+    return datetime.combine(parse_date(query['date']), parse_time(query['time']))
+
+def planner_answer(rp, query):
+    """ Returns route planner's answer dict for query """
+    if query['query'] == 'next':
+        when = query_when(query)
+        destination = check_destination(rp, query['destination'],
+                                        RoutePlanner._service_minute(when)[0])
+        return {'result' : rp.next_departure(when, destination,
+                                             query['northbound'])}
+    return answer_query(rp, query)
+
+def service_days(when):
+    """ Returns (service date, minute) pairs a query at given time searches,
+    in order until one has a result. Times before the service day start are
+    past 24h of the previous date's service, then the same date's """
+    minute = when.hour * 60 + when.minute
+    if when.hour < RoutePlanner.SERVICE_DAY_START_HOUR:
+        return [(when.date() - timedelta(days=1), minute + 24 * 60),
+                (when.date(), minute)]
+    return [(when.date(), minute)]
+
+def scan_answer(rp, timetable, query):
+    """ Returns answer dict for query, scanning all trains of its service
+    days """
+    when = query_when(query)
+    days = service_days(when)
+    destination = check_destination(rp, query['destination'], days[0][0])
+    if query['query'] == 'next':
+        for day, minute in days:
+            schedule = timetable.day_schedules(day)[0 if query['northbound']
+                                                    else 1]
+            result = scan_next(schedule, minute, destination)
+            if result:
+                break
+        return {'result' : result}
+    location = make_location(query.get('coords'), query.get('address'))
+    for day, minute in days:
+        nb, sb = timetable.day_schedules(day)
+        origin = str(nb.find_nearest_station(location))
+        for schedule in (nb, sb):
+            if schedule.is_valid_direction(origin, destination):
+                result = scan_route(schedule, query['query'], minute, origin,
+                                    destination)
+                if result:
+                    return {'origin' : origin, 'result' : result}
+                break
+    raise Usage("No routes from nearest station: " + origin)
+
+def scan_route(schedule, kind, minute, origin, destination):
+    """ Returns result of query kind on schedule at minute of its service
+    day, scanning all trains from origin to destination """
+    orig_minutes = schedule.station_minutes(origin)
+    dest_minutes = schedule.station_minutes(destination)
+    cols = [col for col in xrange(len(orig_minutes))
+            if orig_minutes[col] is not None and dest_minutes[col] is not None]
+    if kind == 'arrive_by':
+        # Latest departure, then earliest arrival, by the deadline
+        best = None
+        for col in cols:
+            key = (orig_minutes[col], -dest_minutes[col])
+            if dest_minutes[col] <= minute and (best is None or key > best[0]):
+                best = (key, col)
+        if best is None:
+            return None
+        return OrderedDict((
+            ('departure', schedule.station_time(origin, best[1])),
+            ('arrival', schedule.station_time(destination, best[1]))))
+    cols = [col for col in cols if orig_minutes[col] >= minute]
+    if not cols:
+        return None
+    if kind == 'earliest':
+        return schedule.station_time(origin, min(cols,
+                                        key=lambda col: orig_minutes[col]))
+    # Fastest: departures of each duration, in train order
+    durations = OrderedDict()
+    for col in cols:
+        duration = dest_minutes[col] - orig_minutes[col]
+        durations.setdefault(duration, []).append(
+                schedule.station_time(origin, col))
+    result = [{str(timedelta(minutes=duration)) : durations[duration]}
+              for duration in sorted(durations)]
+    if kind == 'fastest':
+        result = [{result[0].keys()[0] : result[0].values()[0][:1]}]
+    return result
+
+def scan_next(schedule, minute, station):
+    """ Returns departure time of next train leaving station at or after
+    minute of the schedule's service day, or None. Trains ending at the
+    station don't leave it """
+    st_names = schedule.list_stations()
+    if station not in st_names:
+        return None
+    idx = st_names.index(station)
+    minutes = [schedule.station_minutes(name) for name in st_names]
+    best = None
+    for col in xrange(len(minutes[idx])):
+        departure = minutes[idx][col]
+        if departure is None or departure < minute or \
+                all(m[col] is None for m in minutes[idx + 1:]):
+            continue
+        if best is None or departure < minutes[idx][best]:
+            best = col
+    return None if best is None else schedule.station_time(station, best)
+
+def run_query(answer, query):
+    """ Returns answer to query, or error dict, as plain JSON data """
+    try:
+        reply = answer(query)
+    except Usage as err:
+        reply = {'error' : err.msg}
+    except Exception as e:
+        reply = {'error' : "Exception answering query: %s" % e}
+    return json.loads(json.dumps(reply))
+
+def load_engine(path):
+    """ Returns engine function from module:function path """
+    try:
+        module_name, function_name = path.split(':')
+        return getattr(__import__(module_name), function_name)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise Usage("Can't load engine %s: %s" % (path, e))
+
+# -------------------------------------------------------------------------------
+# Harness
+#
+# Runs queries on random timetables with the reference and every engine,
+# timing each engine's answers. Engines may keep state between queries (like
+# the query cache), so each answers a timetable's queries in order. The first
+# mismatch of an engine on a timetable is minimized: down to the failing query
+# alone if it fails on its own, then by dropping trains and stations while
+# the results still differ.
+# -------------------------------------------------------------------------------
+class Harness(object):
+
+    # --------------------------------
+    def __init__(self, engines=ENGINES, seed=None):
+        """ Init with dict of engines by name, and random seed """
+        self._engines = engines
+        self._seed = seed
+        self._rng = random.Random(seed)
+
+    # --------------------------------
+    def run(self, num_timetables=20, num_queries=200):
+        """ Returns report dict with timing per engine (reference
+        included) and mismatches found """
+        names = ['reference'] + list(self._engines)
+        timing = OrderedDict((name, [0.0, 0.0, 0]) for name in names)
+        mismatches = []
+        for i in xrange(num_timetables):
+            spec = random_timetable(self._rng)
+            queries = random_queries(self._rng, spec, num_queries)
+            expected = self._answer_all('reference', reference_engine, spec,
+                                        queries, timing)
+            for name, engine in self._engines.items():
+                answers = self._answer_all(name, engine, spec, queries, timing)
+                for idx in xrange(len(queries)):
+                    if answers[idx] != expected[idx]:
+                        mismatches.append(self._reproducer(name, engine, spec,
+                                                           queries[:idx + 1]))
+                        break
+        return OrderedDict((
+            ('seed', self._seed),
+            ('timetables', num_timetables),
+            ('queries', num_timetables * num_queries),
+            ('timing', OrderedDict((name, OrderedDict((
+                    ('build_seconds', round(build, 6)),
+                    ('query_seconds', round(queries, 6)),
+                    ('us_per_query', round(queries * 1e6 / count, 2)
+                                     if count else None))))
+                for name, (build, queries, count) in timing.items())),
+            ('mismatches', mismatches)))
+
+    # --------------------------------
+    def _answer_all(self, name, engine, spec, queries, timing):
+        """ Returns engine's answers to queries, adding to its timing """
+        start = time.time()
+        answer = engine(build_schedules(spec))
+        built = time.time()
+        answers = [run_query(answer, query) for query in queries]
+        timing[name][0] += built - start
+        timing[name][1] += time.time() - built
+        timing[name][2] += len(queries)
+        return answers
+
+    # --------------------------------
+    def _reproducer(self, name, engine, spec, history):
+        """ Returns minimized reproducer of engine's answer to last query
+        in history differing from reference """
+        if self._differs(engine, spec, history[-1:]):
+            history = history[-1:]
+        keep = set(query['destination'] for query in history)
+        smaller = True
+        while smaller:
+            smaller = False
+            for candidate in Harness._smaller_specs(spec, keep):
+                if self._differs(engine, candidate, history):
+                    spec, smaller = candidate, True
+                    break
+        schedules = build_schedules(spec)
+        answer = engine(schedules)
+        for query in history[:-1]:
+            run_query(answer, query)
+        return OrderedDict((
+            ('engine', name),
+            ('query', history[-1]),
+            ('expected', run_query(reference_engine(build_schedules(spec)),
+                                   history[-1])),
+            ('actual', run_query(answer, history[-1])),
+            ('previous_queries', history[:-1]),
+            ('timetable', spec)))
+
+    # --------------------------------
+    def _differs(self, engine, spec, history):
+        """ Returns true if engine answers last query in history on
+        timetable differently from reference """
+        answer = engine(build_schedules(spec))
+        for query in history[:-1]:
+            run_query(answer, query)
+        return run_query(answer, history[-1]) != \
+               run_query(reference_engine(build_schedules(spec)), history[-1])
+
+    # --------------------------------
+    @staticmethod
+    def _smaller_specs(spec, keep):
+        """ Yields copies of timetable spec with one train, or one station
+        not named in keep, removed """
+        for s_idx, sched in enumerate(spec['schedules']):
+            for t_idx in xrange(len(sched['trains'])):
+                candidate = json.loads(json.dumps(spec),
+                                       object_pairs_hook=OrderedDict)
+                del candidate['schedules'][s_idx]['trains'][t_idx]
+                yield candidate
+        if len(spec['stations']) <= 2:
+            return
+        for name, lat, lon in spec['stations']:
+            if name in keep:
+                continue
+            candidate = json.loads(json.dumps(spec), object_pairs_hook=OrderedDict)
+            candidate['stations'] = [st for st in candidate['stations']
+                                     if st[0] != name]
+            for sched in candidate['schedules']:
+                idx = sched['stations'].index(name)
+                del sched['stations'][idx]
+                for train in sched['trains']:
+                    del train[idx]
+            yield candidate
+
+# -------------------------------------------------------------------------------
+# Usage
+#
+# Command-line usage instructions
+# -------------------------------------------------------------------------------
+USAGE = """
+
+Usage: caltrain_harness [-j] [-s seed] [-t timetables] [-q queries] [-e module:function]
+    -s  Random seed (random otherwise, reported for reruns)
+    -t  Number of random timetables (20 otherwise)
+    -q  Number of queries per timetable (200 otherwise)
+    -e  Check engine function instead of built in ones, may be repeated
+    -j  Display report in JSON
+
+Answers random queries on random timetables with the reference route planner
+and alternative engines, reporting per engine timing and any mismatching
+results with a minimized reproducer. Exits with 1 if any results mismatch.
+
+An engine function takes a tuple of weekday northbound, weekday southbound,
+weekend northbound and weekend southbound schedules, and returns a function
+answering query dicts like caltrain.answer_query.
+
+Examples:
+
+    Check built in engines on 50 timetables:
+        caltrain_harness.py -t 50
+
+    Check an engine of module fastpath.py, in JSON:
+        caltrain_harness.py -j -e fastpath:make_engine
+
+"""
+
+# -------------------------------------------------------------------------------
+# main
+# -------------------------------------------------------------------------------
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv
+    try:
+        seed = random.randint(0, 2 ** 31)
+        num_timetables = 20
+        num_queries = 200
+        engines = OrderedDict()
+        output_JSON = False
+
+        try:
+            opts, args = getopt.getopt(argv[1:], "js:t:q:e:", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+
+        try:
+            for o, a in opts:
+                if o == "--help":
+                    raise Usage(USAGE)
+                elif o == "-s":
+                    seed = int(a)
+                elif o == "-t":
+                    num_timetables = int(a)
+                elif o == "-q":
+                    num_queries = int(a)
+                elif o == "-e":
+                    engines[a] = load_engine(a)
+                elif o == "-j":
+                    output_JSON = True
+        except ValueError:
+            raise Usage("Seed and counts must be numbers")
+        if args:
+            raise Usage(USAGE)
+
+        report = Harness(engines or ENGINES, seed).run(num_timetables,
+                                                       num_queries)
+        if output_JSON:
+            print json.dumps(report, indent=2)
+        else:
+            print "Seed %(seed)s, %(timetables)s timetables, %(queries)s queries" \
+                  % report
+            for name, t in report['timing'].items():
+                print "%-20s build %8.3fs  queries %8.3fs  %8s us/query" % (
+                        name, t['build_seconds'], t['query_seconds'],
+                        t['us_per_query'])
+            for mismatch in report['mismatches']:
+                print
+                print "Mismatch in %s:" % mismatch['engine']
+                print json.dumps(mismatch, indent=2)
+        return 1 if report['mismatches'] else 0
+
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "for help use --help"
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
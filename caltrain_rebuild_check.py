@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------------------
+# caltrain_rebuild_check.py
+#
+# Checks caltrain.py timetable rebuilds. Rebuilds random timetables into cache
+# files in a temporary directory, as -z runs would from the Caltrain page: the
+# first build without any cache files, then timetable versions effective
+# later, earlier and on the same date as existing ones, and corrections of
+# them. After each rebuild the version index, the timetable effective on
+# checked dates, the cache file mode and lock files are checked, and a planner
+# kept across rebuilds must answer queries like one freshly loaded from the
+# cache files.
+# -------------------------------------------------------------------------------
+
+import os
+import sys
+import getopt
+import json
+import random
+import shutil
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
+
+from caltrain import Cache, RoutePlanner, Usage
+from caltrain_harness import (FIRST_QUERY_DATE, build_schedules, planner_answer,
+                              random_queries, random_timetable, random_trains,
+                              run_query)
+
+# -------------------------------------------------------------------------------
+# SpecPlanner
+#
+# Route planner rebuilding from a timetable spec (see caltrain_harness.py)
+# instead of the Caltrain page. The spec can change between rebuilds, like the
+# page does.
+# -------------------------------------------------------------------------------
+class SpecPlanner(RoutePlanner):
+
+    # --------------------------------
+    def __init__(self):
+        """ Default constructor """
+        RoutePlanner.__init__(self)
+        self._spec = None
+
+    # --------------------------------
+    def set_spec(self, spec):
+        """ Sets timetable spec next rebuilds fetch """
+        self._spec = spec
+
+    # --------------------------------
+    def fetch_schedules(self, stations):
+        """ Returns timetable spec schedules instead of parsing the web page """
+        return build_schedules(self._spec, stations)
+
+# -------------------------------------------------------------------------------
+# Rebuild checks
+#
+# Each timetable's station names are distinct, so the stations listed on a
+# date tell which version is effective, except for corrections, which keep
+# their stations and only change trains. Those show in query answers.
+# -------------------------------------------------------------------------------
+def retimed(rng, spec):
+    """ Returns copy of timetable spec with the same stations and new
+    random trains, as a corrected timetable """
+    corrected = json.loads(json.dumps(spec), object_pairs_hook=OrderedDict)
+    for sched in corrected['schedules']:
+        sched['trains'] = random_trains(rng, len(sched['stations']), 12)
+    return corrected
+
+def check_rebuilds(rng, num_queries=20):
+    """ Returns list of failure messages of rebuild checks, querying
+    each checked date num_queries times """
+    day = lambda days: FIRST_QUERY_DATE + timedelta(days=days)
+    specs = [random_timetable(rng, prefix=prefix) for prefix in "abcd"]
+    specs.append(retimed(rng, specs[2]))
+    # Spec rebuilt, effective day, expected index (effective from and to
+    # days, spec index) and checked days (day, spec index)
+    steps = [
+        (0, None, [(None, None, 0)], [(-5, 0), (40, 0)]),
+        (1, 30, [(None, 29, 0), (30, None, 1)], [(29, 0), (30, 1)]),
+        (2, 10, [(None, 9, 0), (10, 29, 2), (30, None, 1)],
+                [(9, 0), (10, 2), (29, 2), (30, 1)]),
+        (2, 11, [(None, 9, 0), (10, 29, 2), (30, None, 1)], [(11, 2)]),
+        (4, 10, [(None, 9, 0), (10, 29, 4), (30, None, 1)],
+                [(9, 0), (10, 4), (29, 4)]),
+        (3, 30, [(None, 9, 0), (10, 29, 4), (30, None, 3)],
+                [(0, 0), (10, 4), (30, 3), (100, 3)])]
+    failures = []
+    # Same queries on a date each time its stations are checked, so the
+    # kept planner's cached answers are asked again
+    queries = {}
+    # Cache file mode, kept by rebuilds once changed
+    mode = Cache.DEFAULT_MODE
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        kept = SpecPlanner()
+        for num, (spec_idx, effective, expected, checks) in enumerate(steps):
+            step = "step %d, effective %s" % (num + 1, effective)
+            if num == 2:
+                mode = 0664
+                os.chmod(RoutePlanner._cache_file_path, mode)
+            try:
+                kept.set_spec(specs[spec_idx])
+                kept.load(True, effective_date=
+                          day(effective) if effective is not None else None)
+                # Load again from cache files, as the next run would
+                rp = RoutePlanner(query_cache_size=0)
+                rp.load()
+            except Usage as err:
+                failures.append("%s: %s" % (step, err.msg))
+                break
+            except Exception as e:
+                failures.append("%s: exception %r" % (step, e))
+                break
+            file_mode = os.stat(RoutePlanner._cache_file_path).st_mode & 0777
+            if file_mode != mode:
+                failures.append("%s: cache file mode %o" % (step, file_mode))
+            if os.path.exists(RoutePlanner._cache_file_path + '.lock'):
+                failures.append("%s: lock file left behind" % step)
+            versions = [(v_from and (v_from - FIRST_QUERY_DATE).days,
+                         v_to and (v_to - FIRST_QUERY_DATE).days)
+                        for v_from, v_to, path in rp.timetable_versions()]
+            if versions != [(v_from, v_to) for v_from, v_to, i in expected]:
+                failures.append("%s: index %s" % (step, versions))
+            for days, i in checks:
+                names = [st[0] for st in specs[i]['stations']]
+                if rp.list_stations(day(days)) != sorted(names):
+                    failures.append("%s: wrong timetable on day %d" % (step, days))
+                key = (days, tuple(names))
+                if key not in queries:
+                    queries[key] = random_queries(rng, specs[i], num_queries)
+                    for query in queries[key]:
+                        query['date'] = day(days).strftime('%m-%d-%Y')
+                for query in queries[key]:
+                    if run_query(lambda q: planner_answer(kept, q), query) != \
+                            run_query(lambda q: planner_answer(rp, q), query):
+                        failures.append("%s: kept planner answers %s "
+                                        "differently" % (step, json.dumps(query)))
+                        break
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return failures
+
+# -------------------------------------------------------------------------------
+# Usage
+#
+# Command-line usage instructions
+# -------------------------------------------------------------------------------
+USAGE = """
+
+Usage: caltrain_rebuild_check [-s seed] [-q queries]
+    -s  Random seed (random otherwise, reported for reruns)
+    -q  Number of queries per checked date (20 otherwise)
+
+Rebuilds random timetables into cache files in a temporary directory, as
+caltrain.py -z runs would, and checks the resulting timetable versions, cache
+files and query answers. Exits with 1 if any check fails.
+
+"""
+
+# -------------------------------------------------------------------------------
+# main
+# -------------------------------------------------------------------------------
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv
+    try:
+        seed = random.randint(0, 2 ** 31)
+        num_queries = 20
+
+        try:
+            opts, args = getopt.getopt(argv[1:], "s:q:", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+
+        try:
+            for o, a in opts:
+                if o == "--help":
+                    raise Usage(USAGE)
+                elif o == "-s":
+                    seed = int(a)
+                elif o == "-q":
+                    num_queries = int(a)
+        except ValueError:
+            raise Usage("Seed and count must be numbers")
+        if args:
+            raise Usage(USAGE)
+
+        failures = check_rebuilds(random.Random(seed), num_queries)
+        print "Seed %s, %d failures" % (seed, len(failures))
+        for failure in failures:
+            print "Rebuild failure: %s" % failure
+        return 1 if failures else 0
+
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "for help use --help"
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())